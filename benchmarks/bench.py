@@ -0,0 +1,289 @@
+"""Offline benchmark of the scan, /list and ltv hot paths.
+
+Runs against the fake LCD and telegram servers and the in memory redis and
+mongo stand-ins in `fakes.py`, so it needs no running service:
+
+    poetry run python -m benchmarks.bench --addresses 1000 10000 --lcd-latency 0.02
+
+Reports, per size, ltv queries per second, scan cycles per second, /list
+latency, p50/p99 alert latency (from the start of a cycle to the fake telegram
+receiving the alert) and peak python memory, as json with `--json`. With
+`--check` the run fails when a report is past its `LIMITS`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+import tracemalloc
+from typing import Any
+
+from aiogram import Bot as TelegramBot
+from aiogram import types
+from aiogram.bot.api import TelegramAPIServer
+from aiohttp import web
+from beanie.odm.fields import PydanticObjectId
+
+from terra_ltv_bot.bot import Bot
+from terra_ltv_bot.config import Config
+from terra_ltv_bot.handlers import Handlers
+from terra_ltv_bot.index import SubscriptionIndex
+from terra_ltv_bot.models import Subscription
+from terra_ltv_bot.scheduler import Scheduler
+from terra_ltv_bot.tasks import BLOCK_TIME, Tasks
+
+from .fakes import (
+    FakeCollection,
+    FakeLCD,
+    FakeRedis,
+    FakeTelegram,
+    random_address,
+    start_server,
+)
+
+MARKET = "terra1market"
+OVERSEER = "terra1overseer"
+USERS = 100
+# bounds of `--check`, set for `make bench-check` with room for slow machines:
+# the LCD requests catch a scan falling back to one query per address, the
+# alerts a scan that stopped alerting
+LIMITS = {
+    "ltv_per_second": ("min", 5),
+    "lcd_requests_per_address": ("max", 0.25),
+    "alerts_per_cycle": ("min", 1),
+    "alert_latency_p99": ("max", 10),
+    "list_latency_p50": ("max", 0.5),
+    "peak_memory_mb": ("max", 50),
+}
+
+
+class NoLoops:
+    """Dispatcher stand-in so `Tasks` does not start its background loops."""
+
+    def _loop_create_task(self, coro: Any) -> None:
+        coro.close()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def check(report: dict[str, Any], limits: dict[str, tuple[str, float]]) -> list[str]:
+    """The metrics of `report` past their `limits`."""
+    failures = []
+    for key, (bound, limit) in limits.items():
+        value = report[key]
+        if (value > limit) if bound == "max" else (value < limit):
+            failures.append(f"{key}={value:.4g}, {bound} {limit:g}")
+    return failures
+
+
+def synthetic_positions(count: int, seed: int) -> dict[str, tuple[int, int]]:
+    """Loans and collaterals spread so ltvs range from 0 to ~60%."""
+    rng = random.Random(seed)
+    positions = {}
+    for _ in range(count):
+        collateral = rng.randint(1_000, 1_000_000) * 1_000_000
+        loan = int(collateral * 0.6 * rng.random() * 0.55)
+        positions[random_address(rng)] = (loan, collateral)
+    return positions
+
+
+def configure(lcd_url: str, args: argparse.Namespace) -> Config:
+    os.environ.update(
+        BOT_TOKEN="42:benchmark",
+        LCD_URL=lcd_url,
+        CHAIN_ID="localterra",
+        ANCHOR_MARKET_CONTRACT=MARKET,
+        ANCHOR_OVERSEER_CONTRACT=OVERSEER,
+        TELEGRAM_ADMIN_USERMAMES="benchmark",
+        SCAN_BUDGET="1000000000",
+    )
+    return Config.from_env()
+
+
+def populate(
+    index: SubscriptionIndex, positions: dict[str, tuple[int, int]], seed: int
+) -> None:
+    rng = random.Random(seed)
+    for account_address in positions:
+        telegram_id = rng.randrange(USERS) + 1
+        index.add(
+            account_address,
+            Subscription.construct(
+                id=PydanticObjectId(),
+                address_id=PydanticObjectId(),
+                protocol="anchor",
+                alert_threshold=rng.choice([None, 30, 40, 50]),
+                telegram_id=telegram_id,
+                telegram_name=f"user{telegram_id}",
+            ),
+        )
+
+
+def command(telegram_id: int, text: str) -> types.Message:
+    name = text.split()[0]
+    return types.Message.to_object(
+        {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": dict(id=telegram_id, type="private"),
+            "from": dict(
+                id=telegram_id,
+                is_bot=False,
+                first_name="benchmark",
+                username=f"user{telegram_id}",
+            ),
+            "text": text,
+            "entities": [dict(type="bot_command", offset=0, length=len(name))],
+        }
+    )
+
+
+async def start(
+    positions: dict[str, tuple[int, int]], args: argparse.Namespace
+) -> tuple[Bot, FakeLCD, FakeTelegram, list[web.AppRunner]]:
+    """The bot wired to fresh fake servers and stores."""
+    lcd = FakeLCD(positions, args.lcd_latency, args.error_rate, args.seed)
+    telegram = FakeTelegram()
+    lcd_runner, lcd_url = await start_server(lcd.app)
+    telegram_runner, telegram_url = await start_server(telegram.app)
+    app = Bot(configure(lcd_url, args))
+    app.bot = TelegramBot(
+        token=app.config.bot_token,
+        parse_mode=types.ParseMode.HTML,
+        server=TelegramAPIServer.from_base(telegram_url),
+    )
+    TelegramBot.set_current(app.bot)
+    app.dp.bot = app.bot
+    app.outbox.bot = app.bot
+    # measure the bot, not telegram's limits
+    app.outbox.rate = 10 ** 6
+    app.outbox.chat_interval = 0
+    redis = FakeRedis()
+    for holder in (
+        app,
+        app.dp.storage,
+        app.throttler,
+        app.ltv_cache,
+        app.outbox,
+        app.snapshot,
+    ):
+        holder.redis = redis  # type: ignore
+    app.history._collection = FakeCollection  # type: ignore
+    populate(app.index, positions, args.seed)
+    return app, lcd, telegram, [lcd_runner, telegram_runner]
+
+
+async def stop(app: Bot, runners: list[web.AppRunner]) -> None:
+    for runner in runners:
+        await runner.cleanup()
+    await app.bot.close()
+
+
+async def run(size: int, args: argparse.Namespace) -> dict[str, Any]:
+    positions = synthetic_positions(size, args.seed)
+    app, lcd, telegram, runners = await start(positions, args)
+    handlers = Handlers(
+        dp=app.dp,
+        terra=app.terra,
+        redis=app.redis,
+        config=app.config,
+        ltv_cache=app.ltv_cache,
+        index=app.index,
+        throttler=app.throttler,
+        history=app.history,
+    )
+    handlers.set_roles([f"user{i + 1}" for i in range(USERS)])
+    tasks = Tasks(
+        NoLoops(),  # type: ignore
+        app.terra,
+        app.redis,
+        app.outbox,
+        app.ltv_cache,
+        app.index,
+        app.scheduler,
+        app.history,
+        app.shards,
+        app.positions,
+    )
+    outbox = asyncio.create_task(app.outbox.run())
+    tracemalloc.start()
+    report: dict[str, Any] = dict(addresses=size)
+
+    sample = list(positions)[: min(size, 1000)]
+    started = time.perf_counter()
+    await asyncio.gather(*[app.terra.ltv(a) for a in sample])
+    report["ltv_per_second"] = len(sample) / (time.perf_counter() - started)
+
+    cycle_times, alert_latencies = [], []
+    for _ in range(args.cycles):
+        # every cycle checks every address again and alerts again
+        await app.redis.flushdb()
+        tasks.scheduler = Scheduler(
+            block_time=BLOCK_TIME,
+            max_interval=app.config.scan_max_interval,
+            budget=app.config.scan_budget,
+        )
+        tasks.update_schedule(app.index.by_address)
+        received = len(telegram.messages)
+        requests = lcd.requests
+        started = time.perf_counter()
+        await tasks.scan()
+        cycle_times.append(time.perf_counter() - started)
+        while await app.redis.llen("outbox:messages") or await app.redis.llen(
+            "outbox:processing"
+        ):
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        alert_latencies += [t - started for t, _ in telegram.messages[received:]]
+        report["lcd_requests_per_cycle"] = lcd.requests - requests
+    report["lcd_requests_per_address"] = report["lcd_requests_per_cycle"] / size
+    report["cycles_per_second"] = len(cycle_times) / sum(cycle_times)
+    report["alerts_per_cycle"] = len(alert_latencies) / args.cycles
+    report["alert_latency_p50"] = percentile(alert_latencies, 0.5)
+    report["alert_latency_p99"] = percentile(alert_latencies, 0.99)
+
+    list_times = []
+    for telegram_id in range(1, min(USERS, 20) + 1):
+        started = time.perf_counter()
+        await handlers.list_(command(telegram_id, "/list"))
+        list_times.append(time.perf_counter() - started)
+    report["list_latency_p50"] = statistics.median(list_times)
+
+    report["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    outbox.cancel()
+    await stop(app, runners)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--addresses", type=int, nargs="+", default=[1000])
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--lcd-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+    reports = [asyncio.run(run(size, args)) for size in args.addresses]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print(" ".join(f"{key}={value:.4g}" for key, value in report.items()))
+    if args.check:
+        failures = [f for report in reports for f in check(report, LIMITS)]
+        if failures:
+            raise SystemExit("over the limits: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
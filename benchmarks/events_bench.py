@@ -0,0 +1,146 @@
+"""Time to alert after a borrow, with and without block events.
+
+Runs the scan loop against the fake LCD, telegram and tendermint servers
+and the in memory stores of `fakes.py`, like `bench.py`. Once every address
+was checked, safe borrowers borrow past their threshold one at a time with a
+transaction on the market contract, and the time until their alert reaches
+telegram is measured:
+
+    poetry run python -m benchmarks.events_bench --addresses 1000 --borrows 20
+
+Reports, with and without `TENDERMINT_WS_URL`, p50/p99 time to alert, the
+borrows not alerted within `--timeout` and LCD requests per borrow. With
+`--check` the run fails when the block events report is past its `LIMITS`.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any
+
+from terra_ltv_bot.events import BlockEvents
+from terra_ltv_bot.tasks import Tasks
+
+from .bench import (
+    MARKET,
+    NoLoops,
+    check,
+    percentile,
+    start,
+    stop,
+    synthetic_positions,
+)
+from .fakes import FakeTendermint, start_server
+
+# bounds of `--check` for `make bench-check`, which has a 1s block time, only
+# the run with block events is expected to alert every borrow
+LIMITS = {
+    "timeouts": ("max", 0),
+    "time_to_alert_p99": ("max", 3),
+    "lcd_requests_per_borrow": ("max", 20),
+}
+
+
+async def produce_blocks(tendermint: FakeTendermint, block_time: float) -> None:
+    while True:
+        await tendermint.block()
+        await asyncio.sleep(block_time)
+
+
+async def run(with_events: bool, args: argparse.Namespace) -> dict[str, Any]:
+    positions = synthetic_positions(args.addresses, args.seed)
+    app, lcd, telegram, runners = await start(positions, args)
+    tendermint = FakeTendermint()
+    runner, url = await start_server(tendermint.app)
+    runners.append(runner)
+    events = None
+    if with_events:
+        events = BlockEvents(url.replace("http", "ws") + "/websocket", app.terra)
+    tasks = Tasks(
+        NoLoops(),  # type: ignore
+        app.terra,
+        app.redis,
+        app.outbox,
+        app.ltv_cache,
+        app.index,
+        app.scheduler,
+        app.history,
+        events=events,
+    )
+    tasks.update_schedule(app.index.drain_changes())
+    background = [
+        asyncio.create_task(app.outbox.run()),
+        asyncio.create_task(produce_blocks(tendermint, args.block_time)),
+    ]
+    if events:
+        background.append(asyncio.create_task(events.run()))
+        while not events.connected:
+            await asyncio.sleep(0.01)
+    background.append(asyncio.create_task(tasks.check_ltv_ratio()))
+    while app.scheduler.ltvs.keys() < app.scheduler.thresholds.keys():
+        await asyncio.sleep(0.1)
+
+    rng = random.Random(args.seed)
+    safe = [a for a, ltv in app.scheduler.ltvs.items() if ltv < 20]
+    latencies, timeouts = [], 0
+    requests = lcd.requests
+    for account_address in rng.sample(safe, min(args.borrows, len(safe))):
+        _, collateral = lcd.positions[account_address]
+        # 54% ltv, over every subscription threshold
+        lcd.positions[account_address] = (int(collateral * 0.6 * 0.9), collateral)
+        received = len(telegram.messages)
+        start_time = time.perf_counter()
+        await tendermint.tx(MARKET, [account_address])
+        deadline = start_time + args.timeout
+        while time.perf_counter() < deadline:
+            alerted = [
+                t
+                for t, data in telegram.messages[received:]
+                if account_address in data.get("text", "")
+            ]
+            if alerted:
+                latencies.append(alerted[0] - start_time)
+                break
+            await asyncio.sleep(0.01)
+        else:
+            timeouts += 1
+    borrows = len(latencies) + timeouts
+    for task in background:
+        task.cancel()
+    await stop(app, runners)
+    return dict(
+        events=with_events,
+        time_to_alert_p50=percentile(latencies, 0.5),
+        time_to_alert_p99=percentile(latencies, 0.99),
+        timeouts=timeouts,
+        lcd_requests_per_borrow=(lcd.requests - requests) / max(borrows, 1),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--addresses", type=int, default=1000)
+    parser.add_argument("--borrows", type=int, default=20)
+    parser.add_argument("--block-time", type=float, default=6)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--lcd-latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+    reports = [asyncio.run(run(with_events, args)) for with_events in (False, True)]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            print(" ".join(f"{key}={value:.4g}" for key, value in report.items()))
+    if args.check:
+        failures = check(reports[1], LIMITS)
+        if failures:
+            raise SystemExit("over the limits: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
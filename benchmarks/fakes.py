@@ -0,0 +1,379 @@
+"""Local stand-ins for the terra LCD, tendermint rpc, telegram bot api and
+the bot's redis and mongo stores."""
+import asyncio
+import base64
+import bisect
+import json
+import random
+import time
+from typing import Any, Optional, Union
+
+from aiohttp import WSMsgType, web
+from bech32 import bech32_encode, convertbits
+
+from terra_ltv_bot.outbox import _send_slot_script
+from terra_ltv_bot.storage import _token_bucket_script
+from terra_ltv_bot.terra import PAGE_LIMIT, canonical_address
+
+COLLATERAL_TOKEN = "terra1bluna"
+ORACLE_CONTRACT = "terra1oracle"
+MAX_LTV = "0.6"
+
+
+def random_address(rng: random.Random) -> str:
+    return bech32_encode("terra", convertbits(rng.randbytes(20), 8, 5))
+
+
+async def start_server(
+    app: web.Application, port: int = 0
+) -> tuple[web.AppRunner, str]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]  # type: ignore
+    return runner, f"http://127.0.0.1:{port}"
+
+
+class FakeLCD:
+    """Anchor market, overseer and oracle contracts over fake positions.
+
+    Every request waits `latency` seconds and fails with `error_rate`
+    probability. `price` can be moved to push borrowers over thresholds.
+    """
+
+    def __init__(
+        self,
+        positions: dict[str, tuple[int, int]],
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+    ) -> None:
+        self.positions = positions
+        self.ordered = sorted(positions, key=canonical_address)
+        self.canonicals = [canonical_address(a) for a in self.ordered]
+        self.latency = latency
+        self.error_rate = error_rate
+        self.price = 1.0
+        self.requests = 0
+        self.rng = random.Random(seed)
+        self.app = web.Application()
+        self.app.router.add_get("/wasm/contracts/{contract}/store", self.store)
+        self.app.router.add_get("/blocks/latest", self.latest_block)
+
+    async def latest_block(self, _: web.Request) -> web.Response:
+        height = int(time.time() / 6)
+        return web.json_response(dict(block=dict(header=dict(height=str(height)))))
+
+    def _page(self, start_after: Optional[str], limit: int) -> list[str]:
+        if start_after is None:
+            start = 0
+        else:
+            start = bisect.bisect_right(
+                self.canonicals, canonical_address(start_after)
+            )
+        return self.ordered[start : start + min(limit, PAGE_LIMIT)]
+
+    def _answer(self, query: dict) -> dict:
+        name, args = next(iter(query.items()))
+        if name == "borrower_info":
+            loan, _ = self.positions.get(args["borrower"], (0, 0))
+            return dict(borrower=args["borrower"], loan_amount=str(loan))
+        if name == "borrow_limit":
+            _, collateral = self.positions.get(args["borrower"], (0, 0))
+            limit = int(collateral * self.price * float(MAX_LTV))
+            return dict(borrower=args["borrower"], borrow_limit=str(limit))
+        if name == "borrower_infos":
+            page = self._page(args.get("start_after"), args.get("limit", 10))
+            return dict(
+                borrower_infos=[
+                    dict(
+                        borrower=a,
+                        interest_index="1",
+                        loan_amount=str(self.positions[a][0]),
+                    )
+                    for a in page
+                ]
+            )
+        if name == "all_collaterals":
+            page = self._page(args.get("start_after"), args.get("limit", 10))
+            return dict(
+                all_collaterals=[
+                    dict(
+                        borrower=a,
+                        collaterals=[[COLLATERAL_TOKEN, str(self.positions[a][1])]],
+                    )
+                    for a in page
+                ]
+            )
+        if name == "state":
+            # listed loans are already accrued
+            return dict(global_interest_index="1")
+        if name == "whitelist":
+            return dict(
+                elems=[dict(collateral_token=COLLATERAL_TOKEN, max_ltv=MAX_LTV)]
+            )
+        if name == "config":
+            return dict(oracle_contract=ORACLE_CONTRACT)
+        if name == "prices":
+            return dict(prices=[dict(asset=COLLATERAL_TOKEN, price=str(self.price))])
+        raise web.HTTPBadRequest(text=json.dumps(dict(error=f"unknown query {name}")))
+
+    async def store(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rng.random() < self.error_rate:
+            return web.json_response(dict(error="fake failure"), status=500)
+        raw = request.query["query_msg"]
+        try:
+            query = json.loads(raw)
+        except ValueError:
+            query = json.loads(base64.b64decode(raw))
+        result = self._answer(query)
+        return web.json_response(dict(height="1", result=result))
+
+
+class FakeTelegram:
+    """Accepts every bot api call and records when messages arrive."""
+
+    def __init__(self) -> None:
+        self.messages: list[tuple[float, dict]] = []
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.method)
+
+    async def method(self, request: web.Request) -> web.Response:
+        data = dict(await request.post())
+        if request.match_info["method"].lower() == "sendmessage":
+            self.messages.append((time.perf_counter(), data))
+        return web.json_response(
+            dict(
+                ok=True,
+                result=dict(
+                    message_id=len(self.messages),
+                    date=int(time.time()),
+                    chat=dict(id=int(data.get("chat_id", 0)), type="private"),
+                    text=data.get("text", ""),
+                ),
+            )
+        )
+
+
+class FakeTendermint:
+    """Tendermint rpc websocket publishing blocks and contract transactions.
+
+    Events are sent to the subscriptions whose query matches, in the shape of
+    tendermint's event results.
+    """
+
+    def __init__(self) -> None:
+        self.subscriptions: list[tuple[web.WebSocketResponse, int, str]] = []
+        self.height = 0
+        self.app = web.Application()
+        self.app.router.add_get("/websocket", self.websocket)
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            call = message.json()
+            if call.get("method") == "subscribe":
+                query = call["params"]["query"]
+                self.subscriptions.append((ws, call["id"], query))
+                await ws.send_json(dict(jsonrpc="2.0", id=call["id"], result={}))
+        self.subscriptions = [s for s in self.subscriptions if s[0] is not ws]
+        return ws
+
+    async def _publish(self, matches: str, events: dict[str, list[str]]) -> None:
+        for ws, request_id, query in list(self.subscriptions):
+            if matches in query:
+                result = dict(query=query, data={}, events=events)
+                await ws.send_json(dict(jsonrpc="2.0", id=request_id, result=result))
+
+    async def block(self, exchange_rates: bool = False) -> None:
+        self.height += 1
+        events = {"tm.event": ["NewBlock"], "block.height": [str(self.height)]}
+        if exchange_rates:
+            events["exchange_rate_update.denom"] = ["uusd"]
+        await self._publish("NewBlock", events)
+
+    async def tx(self, contract_address: str, account_addresses: list[str]) -> None:
+        events = {
+            "tm.event": ["Tx"],
+            "tx.height": [str(self.height)],
+            "message.sender": account_addresses,
+            "wasm.contract_address": [contract_address],
+        }
+        await self._publish(f"'{contract_address}'", events)
+
+
+Value = Union[bytes, str, int, float]
+
+
+def _encode(value: Value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeRedis:
+    """In memory stand-in for the aioredis client, with the commands the bot
+    uses.
+
+    Expirations are ignored and Lua scripts are not run: the throttling ones
+    always allow, the benchmarks measure the bot, not telegram's limits.
+    """
+
+    def __init__(self) -> None:
+        self.data: dict[str, Any] = {}
+        self._pushed: Optional[asyncio.Condition] = None
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    async def flushdb(self) -> None:
+        self.data.clear()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.data.get(key)
+
+    async def set(self, key: str, value: Value, **_: Any) -> bool:
+        self.data[key] = _encode(value)
+        return True
+
+    async def mget(self, keys: list[str]) -> list[Optional[bytes]]:
+        return [self.data.get(key) for key in keys]
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def expire(self, key: str, _: Any) -> bool:
+        return key in self.data
+
+    async def hset(self, key: str, mapping: dict[str, Value]) -> int:
+        self.data.setdefault(key, {}).update(
+            {k: _encode(v) for k, v in mapping.items()}
+        )
+        return len(mapping)
+
+    async def hgetall(self, key: str) -> dict[bytes, bytes]:
+        return {k.encode(): v for k, v in self.data.get(key, {}).items()}
+
+    async def zadd(self, key: str, mapping: dict[str, float]) -> int:
+        zset = self.data.setdefault(key, {})
+        added = len(mapping.keys() - zset.keys())
+        zset.update(mapping)
+        return added
+
+    async def zcard(self, key: str) -> int:
+        return len(self.data.get(key, {}))
+
+    async def zrange(self, key: str, start: int, end: int) -> list[bytes]:
+        zset = self.data.get(key, {})
+        members = sorted(zset, key=lambda m: (zset[m], m))
+        return [m.encode() for m in members[start : end + 1 if end != -1 else None]]
+
+    async def zrem(self, key: str, *members: Value) -> int:
+        zset = self.data.get(key, {})
+        names = [m.decode() if isinstance(m, bytes) else str(m) for m in members]
+        return sum(zset.pop(m, None) is not None for m in names)
+
+    def _list(self, key: str) -> list[bytes]:
+        return self.data.setdefault(key, [])
+
+    async def _notify(self) -> None:
+        if self._pushed is None:
+            self._pushed = asyncio.Condition()
+        async with self._pushed:
+            self._pushed.notify_all()
+
+    async def lpush(self, key: str, *values: Value) -> int:
+        items = self._list(key)
+        for value in values:
+            items.insert(0, _encode(value))
+        await self._notify()
+        return len(items)
+
+    async def rpush(self, key: str, *values: Value) -> int:
+        items = self._list(key)
+        items.extend(_encode(v) for v in values)
+        await self._notify()
+        return len(items)
+
+    async def llen(self, key: str) -> int:
+        return len(self.data.get(key, []))
+
+    async def lrange(self, key: str, start: int, end: int) -> list[bytes]:
+        items = self.data.get(key, [])
+        return items[start : end + 1 if end != -1 else None]
+
+    async def lrem(self, key: str, count: int, value: Value) -> int:
+        items = self.data.get(key, [])
+        value = _encode(value)
+        if value in items:
+            items.remove(value)
+            return 1
+        return 0
+
+    async def execute_command(self, command: str, *args: Any) -> Any:
+        if command != "BLMOVE":
+            raise NotImplementedError(command)
+        source, destination, *_ = args
+        if self._pushed is None:
+            self._pushed = asyncio.Condition()
+        async with self._pushed:
+            await self._pushed.wait_for(lambda: bool(self.data.get(source)))
+            value = self.data[source].pop(0)
+        self._list(destination).append(value)
+        return value
+
+    async def eval(self, script: str, numkeys: int, *args: Any) -> Any:
+        if script == _token_bucket_script:
+            return 1
+        if script == _send_slot_script:
+            # seconds to wait before sending
+            return b"0"
+        raise NotImplementedError(script)
+
+    async def publish(self, channel: str, message: Value) -> int:
+        return 0
+
+
+class FakePipeline:
+    """Queues `FakeRedis` commands and runs them in order on `execute`."""
+
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.commands: list[tuple[str, tuple, dict]] = []
+
+    async def __aenter__(self) -> "FakePipeline":
+        return self
+
+    async def __aexit__(self, *_: Any) -> None:
+        self.commands = []
+
+    def __getattr__(self, name: str) -> Any:
+        def queue(*args: Any, **kwargs: Any) -> "FakePipeline":
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list:
+        commands, self.commands = self.commands, []
+        return [
+            await getattr(self.redis, name)(*args, **kwargs)
+            for name, args, kwargs in commands
+        ]
+
+
+class FakeCollection:
+    """Motor collection accepting the history bulk writes."""
+
+    def __init__(self) -> None:
+        self.writes = 0
+
+    async def bulk_write(self, requests: list, ordered: bool = True) -> None:
+        self.writes += len(requests)
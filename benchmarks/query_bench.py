@@ -0,0 +1,161 @@
+"""Micro-benchmark of the sdk and raw http contract query clients.
+
+Queries `borrower_info` and `borrow_limit` of fake borrowers with both
+clients against the fake LCD, served from another process so only the
+client's CPU is measured, and checks both return the same results:
+
+    poetry run python -m benchmarks.query_bench --queries 2000
+
+Reports, per client, CPU milliseconds per query, p50/p99 sequential latency
+and queries per second with `--concurrency` queries in flight. With `--check`
+the run fails when a client is past its `LIMITS`.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import time
+from typing import Any, Awaitable, Callable
+
+from aiohttp import ClientError, ClientSession
+
+from terra_ltv_bot.lcd import Endpoint
+
+from .bench import MARKET, OVERSEER, check, percentile, synthetic_positions
+from .fakes import FakeLCD, start_server
+
+Query = Callable[[str, dict], Awaitable[Any]]
+# bounds of `--check` for both clients, with room for slow machines
+LIMITS = {
+    "cpu_ms_per_query": ("max", 3),
+    "latency_p99_ms": ("max", 25),
+}
+
+
+def serve(port: int, size: int, seed: int) -> None:
+    async def main() -> None:
+        lcd = FakeLCD(synthetic_positions(size, seed))
+        await start_server(lcd.app, port)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_up(url: str) -> None:
+    async with ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{url}/blocks/latest"):
+                    return
+            except ClientError:
+                await asyncio.sleep(0.1)
+
+
+def queries(addresses: list[str]) -> list[tuple[str, dict]]:
+    return [
+        query
+        for a in addresses
+        for query in (
+            (MARKET, dict(borrower_info=dict(borrower=a))),
+            (OVERSEER, dict(borrow_limit=dict(borrower=a))),
+        )
+    ]
+
+
+async def measure(
+    query: Query, workload: list[tuple[str, dict]], concurrency: int
+) -> dict[str, float]:
+    latencies = []
+    cpu = time.process_time()
+    for contract_address, msg in workload:
+        start = time.perf_counter()
+        await query(contract_address, msg)
+        latencies.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(contract_address: str, msg: dict) -> None:
+        async with semaphore:
+            await query(contract_address, msg)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[limited(c, m) for c, m in workload])
+    elapsed = time.perf_counter() - start
+    return dict(
+        cpu_ms_per_query=cpu / len(workload) * 1000,
+        latency_p50_ms=percentile(latencies, 0.5) * 1000,
+        latency_p99_ms=percentile(latencies, 0.99) * 1000,
+        queries_per_second=len(workload) / elapsed,
+    )
+
+
+async def run(url: str, args: argparse.Namespace) -> dict[str, Any]:
+    await wait_until_up(url)
+    endpoint = Endpoint(url, "localterra")
+    addresses = list(synthetic_positions(args.addresses, args.seed))
+    workload = queries(addresses * (args.queries // (2 * len(addresses)) + 1))
+    workload = workload[: args.queries]
+
+    async def sdk(contract_address: str, msg: dict) -> Any:
+        return await endpoint.lcd.wasm.contract_query(
+            contract_address=contract_address, query=msg
+        )
+
+    async def raw(contract_address: str, msg: dict) -> Any:
+        return await endpoint.raw.contract_query(contract_address, msg)
+
+    for contract_address, msg in queries(addresses[:100]):
+        expected = await sdk(contract_address, msg)
+        if await raw(contract_address, msg) != expected:
+            raise SystemExit(f"raw result differs for {msg}")
+    report = dict(
+        sdk=await measure(sdk, workload, args.concurrency),
+        raw=await measure(raw, workload, args.concurrency),
+    )
+    await endpoint.raw.close()
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--addresses", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+    port = free_port()
+    server = multiprocessing.Process(
+        target=serve, args=(port, args.addresses, args.seed), daemon=True
+    )
+    server.start()
+    try:
+        report = asyncio.run(run(f"http://127.0.0.1:{port}", args))
+    finally:
+        server.terminate()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for client, results in report.items():
+            values = " ".join(f"{key}={value:.4g}" for key, value in results.items())
+            print(client, values)
+    if args.check:
+        failures = [
+            f"{client} {f}"
+            for client, results in report.items()
+            for f in check(results, LIMITS)
+        ]
+        if failures:
+            raise SystemExit("over the limits: " + "; ".join(failures))
+
+
+if __name__ == "__main__":
+    main()
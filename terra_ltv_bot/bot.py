@@ -1,37 +1,91 @@
 import aioredis
 import motor
 import logging
+from typing import TYPE_CHECKING, Optional
+
 from aiogram import Bot as TelegramBot
 from aiogram import types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import Dispatcher
 from aiogram.utils import executor
 from beanie import init_beanie
-from terra_sdk.client.lcd.lcdclient import AsyncLCDClient
 
+from .cache import LtvCache
 from .config import Config
+from .events import BlockEvents
 from .handlers import Handlers
+from .history import History
+from .index import SubscriptionIndex
+from .lcd import LCDPool
+from .metrics import CommandMetricsMiddleware, serve
 from .models import all_models
-from .tasks import Tasks
+from .outbox import Outbox
+from .scheduler import Scheduler
+from .sharding import Shards
+from .snapshot import Snapshot
+from .storage import RedisStorage, Throttler
+from .tasks import BLOCK_TIME, Tasks
 from .terra import Terra
 
+if TYPE_CHECKING:
+    from .positions import Positions
+
 log = logging.getLogger(__name__)
 
+SHARD_LEASE_TTL = 30
+
 
 class Bot:
     def __init__(self, config: Config) -> None:
         self.bot = TelegramBot(token=config.bot_token, parse_mode=types.ParseMode.HTML)
-        self.dp = Dispatcher(self.bot, storage=MemoryStorage())
         self.terra = Terra(
-            AsyncLCDClient(url=config.lcd_url, chain_id=config.chain_id),
+            LCDPool(
+                [url.strip() for url in config.lcd_url.split(",")],
+                chain_id=config.chain_id,
+            ),
             anchor_market_contract=config.anchor_market_contract,
             anchor_overseer_contract=config.anchor_overseer_contract,
+            raw_queries=config.lcd_raw_queries,
         )
         log.info(f"Bot::__init__() {config.db_host}:{config.db_port}")
         self.db = motor.motor_asyncio.AsyncIOMotorClient(
             host=config.db_host, port=config.db_port
         )[config.db_name]
         self.redis = aioredis.from_url(config.redis_url)
+        self.dp = Dispatcher(self.bot, storage=RedisStorage(self.redis))
+        self.dp.middleware.setup(CommandMetricsMiddleware())
+        self.throttler = Throttler(self.redis)
+        self.ltv_cache = LtvCache(
+            self.terra,
+            self.redis,
+            ttl=config.ltv_cache_ttl,
+            max_size=config.ltv_cache_size,
+        )
+        self.index = SubscriptionIndex()
+        self.scheduler = Scheduler(
+            block_time=BLOCK_TIME,
+            max_interval=config.scan_max_interval,
+            budget=config.scan_budget,
+        )
+        self.history = History(retention=config.history_retention)
+        self.shards = (
+            Shards(self.redis, config.scanner_shards, lease_ttl=SHARD_LEASE_TTL)
+            if config.scanner_shards
+            else None
+        )
+        self.positions: Optional["Positions"] = None
+        if config.ltv_from_prices:
+            # numpy is only required in this mode
+            from . import positions
+
+            self.positions = positions.Positions(self.terra)
+        self.outbox = Outbox(self.bot, self.redis, workers=config.outbox_workers)
+        self.events = (
+            BlockEvents(config.tendermint_ws_url, self.terra)
+            if config.tendermint_ws_url
+            else None
+        )
+        self.snapshot = Snapshot(self.redis, self.index, self.scheduler)
+        self.handlers: Optional[Handlers] = None
         self.config = config
 
     async def on_startup(self, dp: Dispatcher):
@@ -41,16 +95,79 @@ class Bot:
             document_models=all_models,
         )
         log.info(f"Bot::on_startup() #2")
-        x = Handlers(dp=dp, terra=self.terra, redis=self.redis, config=self.config)
-        await x.init_hack()
-        Tasks(dp, self.bot, self.terra, self.redis)
+        if self.config.metrics_port:
+            await serve(self.config.webapp_host, self.config.metrics_port)
+        roles = await self.snapshot.restore()
+        if roles is None:
+            await self.index.load()
+        else:
+            # serve commands from the snapshot while mongo catches up
+            dp._loop_create_task(self.load_index())
+        x = self.handlers = Handlers(
+            dp=dp,
+            terra=self.terra,
+            redis=self.redis,
+            config=self.config,
+            ltv_cache=self.ltv_cache,
+            index=self.index,
+            throttler=self.throttler,
+            history=self.history,
+        )
+        if roles is None:
+            await x.init_hack()
+        else:
+            # listen_roles reloads them once subscribed
+            x.set_roles(list(roles))
+        dp._loop_create_task(x.listen_roles())
+        if self.config.webhook_url:
+            # every replica sets the same url, telegram keeps the last one
+            await self.bot.set_webhook(
+                self.config.webhook_url + self.config.webhook_path
+            )
+        Tasks(
+            dp,
+            self.terra,
+            self.redis,
+            self.outbox,
+            self.ltv_cache,
+            self.index,
+            self.scheduler,
+            self.history,
+            self.shards,
+            self.positions,
+            self.config.validator_address,
+            self.config.ltv_epsilon,
+            self.events,
+            self.config.index_reload,
+        )
+
+    async def load_index(self) -> None:
+        await self.index.load()
+        self.snapshot.prune()
 
     async def on_shutdown(self, _: Dispatcher):
-        pass
+        if self.handlers:
+            await self.snapshot.save(self.handlers.roles)
+        if self.shards:
+            await self.shards.leave()
+        await self.terra.pool.close()
 
     def run(self) -> None:
-        executor.start_polling(
-            self.dp,
-            on_startup=self.on_startup,
-            on_shutdown=self.on_shutdown,
-        )
+        if self.config.webhook_url:
+            executor.start_webhook(
+                self.dp,
+                webhook_path=self.config.webhook_path,
+                # only accept updates from telegram, X-Forwarded-For is
+                # honoured behind a load balancer
+                check_ip=True,
+                on_startup=self.on_startup,
+                on_shutdown=self.on_shutdown,
+                host=self.config.webapp_host,
+                port=self.config.webapp_port,
+            )
+        else:
+            executor.start_polling(
+                self.dp,
+                on_startup=self.on_startup,
+                on_shutdown=self.on_shutdown,
+            )
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Iterable, Optional
+
+from aioredis import Redis
+from terra_sdk.exceptions import LCDResponseError
+
+from .metrics import LTV_CACHE
+from .terra import Market, Terra
+
+log = logging.getLogger(__name__)
+
+_ltv_cache_key = "ltv:{}"
+_ltv_index_key = "ltv:index"
+# terra produces a block every ~6s, no need to ask more often than that
+HEIGHT_REFRESH = 2
+
+
+class LtvCache:
+    """Redis cache of ltvs shared by every replica.
+
+    Each address holds its last ltv along with the block height it was read
+    at, and is only served while it is from the latest block. An index sorted
+    by height bounds the number of cached addresses.
+    """
+
+    def __init__(self, terra: Terra, redis: Redis, ttl: int, max_size: int) -> None:
+        self.terra = terra
+        self.redis = redis
+        self.ttl = timedelta(seconds=ttl)
+        self.max_size = max_size
+        self._height = 0
+        self._height_at = 0.0
+
+    async def height(self) -> int:
+        if time.monotonic() - self._height_at > HEIGHT_REFRESH:
+            try:
+                self._height = await self.terra.height()
+            except LCDResponseError as e:
+                # the ltvs are queried from the same nodes, keep serving
+                log.warning(f"Could not get block height: {e}")
+            self._height_at = time.monotonic()
+        return self._height
+
+    async def get_many(
+        self, account_addresses: Iterable[str], height: int
+    ) -> dict[str, float]:
+        """Cached ltvs at least as recent as `height`, misses are left out."""
+        account_addresses = list(account_addresses)
+        if not account_addresses:
+            return {}
+        values = await self.redis.mget(
+            [_ltv_cache_key.format(a) for a in account_addresses]
+        )
+        ltvs = {}
+        for account_address, value in zip(account_addresses, values):
+            if value is None:
+                continue
+            cached_height, ltv = value.decode().split(":")
+            if int(cached_height) >= height:
+                ltvs[account_address] = float(ltv)
+        return ltvs
+
+    async def set_many(self, ltvs: dict[str, float], height: int) -> None:
+        if not ltvs:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for account_address, ltv in ltvs.items():
+                key = _ltv_cache_key.format(account_address)
+                pipe.set(key, f"{height}:{ltv}", ex=self.ttl)
+            pipe.zadd(
+                _ltv_index_key,
+                {_ltv_cache_key.format(a): height for a in ltvs},
+            )
+            pipe.zcard(_ltv_index_key)
+            *_, size = await pipe.execute()
+        if size > self.max_size:
+            await self.evict(size - self.max_size)
+
+    async def invalidate(self, account_addresses: Iterable[str]) -> None:
+        keys = [_ltv_cache_key.format(a) for a in account_addresses]
+        if keys:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*keys)
+                pipe.zrem(_ltv_index_key, *keys)
+                await pipe.execute()
+
+    async def evict(self, count: int) -> None:
+        keys = await self.redis.zrange(_ltv_index_key, 0, count - 1)
+        if keys:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*keys)
+                pipe.zrem(_ltv_index_key, *keys)
+                await pipe.execute()
+            log.debug(f"evicted {len(keys)} cached ltvs")
+
+    async def ltv(self, account_address: str) -> Optional[float]:
+        ltvs = await self.ltv_many([account_address])
+        return ltvs.get(account_address)
+
+    async def ltv_many(
+        self,
+        account_addresses: Iterable[str],
+        bulk: bool = False,
+        market: Optional[Market] = None,
+    ) -> dict[str, float]:
+        """Ltvs from the latest block, querying only the cache misses.
+
+        With `bulk` the misses are fetched with `Terra.ltv_many`, given the
+        `market` if any, otherwise with one `Terra.ltv` per address, which is
+        cheaper for a handful. Addresses that could not be queried are left
+        out.
+        """
+        account_addresses = list(dict.fromkeys(account_addresses))
+        height = await self.height()
+        ltvs = await self.get_many(account_addresses, height)
+        misses = [a for a in account_addresses if a not in ltvs]
+        if misses:
+            fetched: dict[str, float]
+            if bulk:
+                fetched = await self.terra.ltv_many(misses, market)
+            else:
+                results = await asyncio.gather(*[self.terra.ltv(a) for a in misses])
+                fetched = {
+                    a: ltv for a, ltv in zip(misses, results) if ltv is not None
+                }
+            # only ltvs that were queried are cached, a failed lookup is
+            # queried again, and nothing is until a height is known
+            if height:
+                await self.set_many(fetched, height)
+            ltvs.update(fetched)
+        LTV_CACHE.inc(len(account_addresses) - len(misses), result="hit")
+        LTV_CACHE.inc(len(misses), result="miss")
+        return ltvs
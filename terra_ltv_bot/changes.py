@@ -0,0 +1,63 @@
+import logging
+import math
+from array import array
+from typing import Iterable
+
+log = logging.getLogger(__name__)
+
+
+class ChangeFilter:
+    """Last evaluated ltv of each address, in a compact array of doubles.
+
+    Addresses get a slot in the array the first time they are seen, freed
+    slots are reused. Unknown or forgotten ltvs are NaN, so they always count
+    as changed.
+    """
+
+    def __init__(self, epsilon: float) -> None:
+        self.epsilon = epsilon
+        self.slots: dict[str, int] = {}
+        self.ltvs = array("d")
+        self.free: list[int] = []
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def _slot(self, account_address: str) -> int:
+        slot = self.slots.get(account_address)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                slot = len(self.ltvs)
+                self.ltvs.append(math.nan)
+            self.slots[account_address] = slot
+        return slot
+
+    def changed(self, ltvs: dict[str, float]) -> list[str]:
+        """Addresses whose ltv moved by more than epsilon since it last did.
+
+        Their new ltv is recorded, small moves add up until they get over
+        epsilon.
+        """
+        changed = []
+        for account_address, ltv in ltvs.items():
+            slot = self._slot(account_address)
+            previous = self.ltvs[slot]
+            if not abs(ltv - previous) <= self.epsilon:
+                self.ltvs[slot] = ltv
+                changed.append(account_address)
+        return changed
+
+    def forget(self, account_addresses: Iterable[str]) -> None:
+        """Count these addresses as changed next time."""
+        for account_address in account_addresses:
+            slot = self.slots.get(account_address)
+            if slot is not None:
+                self.ltvs[slot] = math.nan
+
+    def remove(self, account_address: str) -> None:
+        slot = self.slots.pop(account_address, None)
+        if slot is not None:
+            self.ltvs[slot] = math.nan
+            self.free.append(slot)
@@ -1,8 +1,14 @@
+import hashlib
 import os
 # import ujson
 from typing import Optional
 
 
+def secret_webhook_path(bot_token: str) -> str:
+    """Default webhook path, only known to whoever has the bot token."""
+    return "/webhook/" + hashlib.sha256(bot_token.encode()).hexdigest()
+
+
 class Config:
     def __init__(
         self,
@@ -18,6 +24,23 @@ class Config:
         anchor_overseer_contract: str,
         telegram_admin_usermames: str,
         validator_address: Optional[str],
+        ltv_cache_ttl: int,
+        ltv_cache_size: int,
+        scanner_shards: int,
+        scan_budget: float,
+        scan_max_interval: int,
+        ltv_from_prices: bool,
+        outbox_workers: int,
+        webhook_url: Optional[str],
+        webhook_path: str,
+        webapp_host: str,
+        webapp_port: int,
+        metrics_port: Optional[int],
+        history_retention: int,
+        ltv_epsilon: float,
+        lcd_raw_queries: bool,
+        tendermint_ws_url: Optional[str],
+        index_reload: int,
     ) -> None:
         self.debug = debug
         self.bot_token = bot_token
@@ -31,6 +54,23 @@ class Config:
         self.anchor_overseer_contract = anchor_overseer_contract
         self.telegram_admin_usermames = telegram_admin_usermames
         self.validator_address = validator_address
+        self.ltv_cache_ttl = ltv_cache_ttl
+        self.ltv_cache_size = ltv_cache_size
+        self.scanner_shards = scanner_shards
+        self.scan_budget = scan_budget
+        self.scan_max_interval = scan_max_interval
+        self.ltv_from_prices = ltv_from_prices
+        self.outbox_workers = outbox_workers
+        self.webhook_url = webhook_url
+        self.webhook_path = webhook_path
+        self.webapp_host = webapp_host
+        self.webapp_port = webapp_port
+        self.metrics_port = metrics_port
+        self.history_retention = history_retention
+        self.ltv_epsilon = ltv_epsilon
+        self.lcd_raw_queries = lcd_raw_queries
+        self.tendermint_ws_url = tendermint_ws_url
+        self.index_reload = index_reload
 
     @classmethod
     def from_env(cls) -> "Config":
@@ -49,4 +89,22 @@ class Config:
             os.environ["ANCHOR_OVERSEER_CONTRACT"],
             os.environ["TELEGRAM_ADMIN_USERMAMES"],
             os.getenv("VALIDATOR_ADDRESS"),
+            int(os.getenv("LTV_CACHE_TTL", "60")),
+            int(os.getenv("LTV_CACHE_SIZE", "100000")),
+            int(os.getenv("SCANNER_SHARDS", "0")),
+            float(os.getenv("SCAN_BUDGET", "10")),
+            int(os.getenv("SCAN_MAX_INTERVAL", "300")),
+            bool(os.getenv("LTV_FROM_PRICES")),
+            int(os.getenv("OUTBOX_WORKERS", "8")),
+            os.getenv("WEBHOOK_URL"),
+            os.getenv("WEBHOOK_PATH")
+            or secret_webhook_path(os.environ["BOT_TOKEN"]),
+            os.getenv("WEBAPP_HOST", "0.0.0.0"),
+            int(os.getenv("WEBAPP_PORT", "8080")),
+            int(os.environ["METRICS_PORT"]) if os.getenv("METRICS_PORT") else None,
+            int(os.getenv("HISTORY_RETENTION", str(30 * 24 * 60 * 60))),
+            float(os.getenv("LTV_EPSILON", "0.1")),
+            bool(os.getenv("LCD_RAW_QUERIES")),
+            os.getenv("TENDERMINT_WS_URL"),
+            int(os.getenv("INDEX_RELOAD", "300")),
         )
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from typing import Any, Iterable
+
+from aiohttp import ClientError, ClientSession, WSMsgType
+from terra_sdk.exceptions import LCDResponseError
+
+from .terra import Terra, is_account_address
+
+log = logging.getLogger(__name__)
+
+RECONNECT_MIN = 1
+RECONNECT_MAX = 60
+# a subscription closes when the node cannot keep up, drop the connection
+# rather than miss blocks silently
+RECEIVE_TIMEOUT = 60
+
+_new_block = "tm.event='NewBlock'"
+_contract_txs = "tm.event='Tx' AND wasm.contract_address='{}'"
+# end block events of the native oracle when a vote period ends
+_exchange_rate = "exchange_rate_update.denom"
+
+
+class BlockEvents:
+    """Follows new blocks and Anchor transactions on a tendermint websocket.
+
+    Every new block and Anchor transaction wakes the scanner. Addresses found
+    in the events of a transaction executing the Anchor market, overseer or
+    oracle contracts are collected for the scanner to check right away, and
+    oracle transactions or
+    exchange rate updates mark the prices as moved. While disconnected the
+    scanner falls back to polling on a timer.
+    """
+
+    def __init__(self, url: str, terra: Terra) -> None:
+        self.url = url
+        self.terra = terra
+        self.connected = False
+        self.touched: set[str] = set()
+        self.moved = True
+        self.blocks = 0
+        self.block = False
+        self._wakeup = asyncio.Event()
+
+    def drain(self) -> set[str]:
+        touched, self.touched = self.touched, set()
+        return touched
+
+    def prices_moved(self) -> bool:
+        """Whether prices may have moved since the last call."""
+        moved = self.moved or not self.connected
+        self.moved = False
+        return moved
+
+    def new_block(self) -> bool:
+        """Whether a block was produced since the last call."""
+        block, self.block = self.block, False
+        return block
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait for the next block or transaction, False on timeout."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._wakeup.clear()
+        return True
+
+    async def queries(self) -> list[str]:
+        contracts = [
+            self.terra.anchor_market_contact,
+            self.terra.anchor_overseer_contact,
+            await self.terra.oracle_contract(),
+        ]
+        return [_new_block, *(_contract_txs.format(c) for c in contracts)]
+
+    async def run(self) -> None:
+        backoff = RECONNECT_MIN
+        while True:
+            try:
+                await self.follow()
+                backoff = RECONNECT_MIN
+            except (
+                ClientError,
+                LCDResponseError,
+                asyncio.TimeoutError,
+                ValueError,
+            ) as e:
+                log.warning(f"block events lost: {e!r}, retrying in {backoff}s")
+            except Exception:
+                # an unexpected event shape must not leave the scan polling
+                log.exception(f"block events failed, retrying in {backoff}s")
+            finally:
+                self.connected = False
+                # anything may have changed while we were not listening
+                self.moved = True
+            await asyncio.sleep(backoff)
+            backoff = min(RECONNECT_MAX, backoff * 2)
+
+    async def follow(self) -> None:
+        queries = await self.queries()
+        async with ClientSession() as session:
+            async with session.ws_connect(self.url, heartbeat=30) as ws:
+                for n, query in enumerate(queries):
+                    await ws.send_json(
+                        dict(
+                            jsonrpc="2.0",
+                            id=n,
+                            method="subscribe",
+                            params=dict(query=query),
+                        )
+                    )
+                self.connected = True
+                log.info(f"following {len(queries)} event queries on {self.url}")
+                while True:
+                    message = await ws.receive(timeout=RECEIVE_TIMEOUT)
+                    if message.type != WSMsgType.TEXT:
+                        log.warning(f"block events closed: {message.type!r}")
+                        return
+                    self.handle(message.json())
+
+    def handle(self, message: dict[str, Any]) -> None:
+        if "error" in message:
+            raise ValueError(message["error"])
+        result = message.get("result") or {}
+        query = result.get("query")
+        if not query:
+            # subscription acknowledgement
+            return
+        events: dict[str, list[str]] = result.get("events") or {}
+        if query == _new_block:
+            self.blocks += 1
+            self.block = True
+            if _exchange_rate in events:
+                self.moved = True
+        else:
+            oracle = self.terra.anchor_oracle_contract
+            if oracle in events.get("wasm.contract_address", []):
+                self.moved = True
+            self.touched.update(addresses(events.values()))
+        self._wakeup.set()
+
+
+def addresses(values: Iterable[list[str]]) -> set[str]:
+    """Account addresses among event attribute values."""
+    return {v for vs in values for v in vs if is_account_address(v)}
@@ -1,22 +1,57 @@
 import asyncio
+import io
 import logging
+import re
+import time
 
 from aiogram import types
 from aiogram.dispatcher import Dispatcher
-from aiogram.utils.exceptions import Throttled
+from aiogram.utils.markdown import quote_html
 from aioredis import Redis
-from pymongo.errors import DuplicateKeyError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from functools import wraps
-from typing import Callable
+from typing import Callable, Optional
 
+from .cache import LtvCache
 from .config import Config
-from .models import Address, Subscription, User
-from .terra import FINDER_URL, Terra
+from .history import RESOLUTION, History
+from .index import SubscriptionIndex
+from .models import Address, Subscription, User, parse_alert_threshold
+from .storage import Throttler
+from .tasks import mute_key
+from .terra import FINDER_URL, Terra, is_account_address
 
 log = logging.getLogger(__name__)
 
-_admins_cache_key = 'telegram:admins'
+_roles_channel = 'telegram:roles'
+# hourly points shown by /history
+HISTORY_POINTS = 24
+# largest address list accepted as a document, in bytes
+MAX_IMPORT_SIZE = 1024 * 1024
+# rejected addresses listed in a bulk subscribe reply
+MAX_REJECTED_SHOWN = 20
+# mongo duplicate key error code
+DUPLICATE_KEY = 11000
+
+
+def parse_subscriptions(text: str) -> list[tuple[str, Optional[str]]]:
+    """(address, threshold) pairs from `address (threshold)` items.
+
+    Items are separated by spaces, commas, semicolons or new lines, so both
+    `/subscribe terra1a 55 terra1b` and `address,threshold` lines parse.
+    """
+    entries: list[tuple[str, Optional[str]]] = []
+    for token in re.split(r"[\s,;]+", text.strip()):
+        if not token:
+            continue
+        if entries and entries[-1][1] is None and not token.startswith("terra"):
+            entries[-1] = (entries[-1][0], token)
+        else:
+            entries.append((token, None))
+    return entries
+
 
 def is_admin(f: Callable) -> Callable:
     async def inner(self, message: types.Message):
@@ -40,15 +75,7 @@ def in_role(f: Callable) -> Callable:
         if user is None: 
             await message.reply('suck it!')
             return False
-        admins = await self.redis.get(_admins_cache_key)
-        admins = admins.decode() if admins is not None else ''
-        log.info(f"is_admin: admins list: {admins}")
-        # admins = '' if admins is None else admins
-        admins_list = str(admins).split(',')
-        admins_list = [*self.telegram_admins, *admins_list]
-        log.info(f"is_admin: admins list array: {admins_list}")
-        username = user.username
-        if username not in admins_list: 
+        if user.username not in self.roles:
             await message.reply('suck it!')
             return False
         
@@ -58,26 +85,68 @@ def in_role(f: Callable) -> Callable:
 
 
 class Handlers:
-    def __init__(self, dp: Dispatcher, terra: Terra, redis: Redis, config: Config) -> None:
+    def __init__(
+        self,
+        dp: Dispatcher,
+        terra: Terra,
+        redis: Redis,
+        config: Config,
+        ltv_cache: LtvCache,
+        index: SubscriptionIndex,
+        throttler: Throttler,
+        history: History,
+    ) -> None:
         self.dp = dp
         self.terra = terra
         self.redis = redis
         self.config = config
+        self.ltv_cache = ltv_cache
+        self.index = index
+        self.throttler = throttler
+        self.history = history
         self.telegram_admins = self.config.telegram_admin_usermames.split(',')
+        self.roles: set[str] = set(self.telegram_admins)
         dp.register_message_handler(self.start, commands=["start", "help"])
         dp.register_message_handler(self.subscribe, commands=["subscribe"])
+        dp.register_message_handler(
+            self.import_, content_types=types.ContentType.DOCUMENT
+        )
         dp.register_message_handler(self.list_, commands=["list"])
         dp.register_message_handler(self.unsubscribe, commands=["unsubscribe"])
         dp.register_message_handler(self.ltv, commands=["ltv"])
+        dp.register_message_handler(self.ltv_history, commands=["history"])
         dp.register_message_handler(self.list_users, commands=["users"])
         dp.register_message_handler(self.add_user, commands=["add_user"])
         dp.register_message_handler(self.remove_user, commands=["rem_user"])
 
     async def init_hack(self):
         users = await User.all().to_list()
-        names = [user.telegram_user for user in users]
-        names = ','.join(names)
-        await self.redis.set(_admins_cache_key, names)
+        self.set_roles([user.telegram_user for user in users])
+
+    def set_roles(self, names: list[str]) -> None:
+        self.roles = {*self.telegram_admins, *names}
+
+    async def publish_roles(self) -> None:
+        """Reload users and push them to every replica."""
+        await self.init_hack()
+        await self.redis.publish(_roles_channel, ','.join(self.roles))
+
+    async def listen_roles(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(_roles_channel)
+                # changes published while we were not listening
+                await self.init_hack()
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.set_roles(message["data"].decode().split(','))
+            except Exception as e:
+                log.warning(f"roles subscription lost: {e}")
+            finally:
+                # gives its connection back to the pool
+                await pubsub.reset()
+            await asyncio.sleep(5)
 
     async def start(self, message: types.Message) -> None:
         log.info(f"@{message.from_user.username} {message.get_args()}")
@@ -99,9 +168,12 @@ class Handlers:
             "/subscribe address (threshold)\n"
             "<pre>/subscribe terra1[...] 55</pre>\n"
             "<pre>/subscribe terra1[...]</pre>\n"
+            "<pre>/subscribe terra1[...] 55 terra1[...] terra1[...] 50</pre>\n"
             "Subscribe to an address LTV alerts.\n"
             "Whe not specified, the alert threshold defaults to "
             "the protocol safe value.\n"
+            "Send a file of <pre>address,threshold</pre> lines to subscribe "
+            "to all of them.\n"
             "\n"
             "/list\nList all subscribed addresses and their current LTV.\n"
             "\n"
@@ -113,6 +185,10 @@ class Handlers:
             "<pre>/ltv terra1[...]</pre>\n"
             "Retreive LTV for an arbitrary address.\n"
             "\n"
+            "/history address\n"
+            "<pre>/history terra1[...]</pre>\n"
+            "Hourly LTV of a scanned address over the last day (UTC).\n"
+            "\n"
             "/users\nList all users that can configure alerts.\n"
             "\n"
             "/add_user telegram_user_name\n"
@@ -129,10 +205,11 @@ class Handlers:
 
     @in_role
     async def subscribe(self, message: types.Message) -> None:
-        try:
-            await self.dp.throttle("add", rate=1)
-        except Throttled:
+        entries = parse_subscriptions(message.get_args())
+        if not await self.throttler.allow(message.from_user.id, "subscribe"):
             await message.reply("too many requests")
+        elif len(entries) > 1:
+            await self.subscribe_many(message, entries)
         else:
             user_id = message.from_user.id
             user_name = message.from_user.username
@@ -157,7 +234,7 @@ class Handlers:
                         if alert_threshold != subscription.alert_threshold:
                             subscription.alert_threshold = alert_threshold
                             await self.redis.delete(
-                                f"{account_address}:anchor:{subscription.telegram_id}"
+                                mute_key(account_address, subscription.telegram_id)
                             )
                     else:
                         subscription = Subscription(
@@ -168,11 +245,12 @@ class Handlers:
                             telegram_name=user_name
                         )
                     await subscription.save()
+                    self.index.add(address.account_address, subscription)
                     await message.reply(
                         "subscribed to "
                         "<a href='{}{}/address/{}'>{}...{}</a>".format(
                             FINDER_URL,
-                            self.terra.lcd.chain_id,
+                            self.terra.pool.chain_id,
                             address.account_address,
                             address.account_address[:13],
                             address.account_address[-5:],
@@ -185,7 +263,7 @@ class Handlers:
                         "already subscribed to "
                         "<a href='{}{}/address/{}'>{}...{}</a>".format(
                             FINDER_URL,
-                            self.terra.lcd.chain_id,
+                            self.terra.pool.chain_id,
                             address.account_address,
                             address.account_address[:13],
                             address.account_address[-5:],
@@ -194,52 +272,175 @@ class Handlers:
             else:
                 await message.reply("invalid format, missing account address")
 
+    @in_role
+    async def import_(self, message: types.Message) -> None:
+        if not await self.throttler.allow(message.from_user.id, "subscribe"):
+            await message.reply("too many requests")
+        elif message.document.file_size > MAX_IMPORT_SIZE:
+            await message.reply("file too large")
+        else:
+            content = io.BytesIO()
+            await message.document.download(destination=content)
+            entries = parse_subscriptions(content.getvalue().decode(errors="replace"))
+            await self.subscribe_many(message, entries)
+
+    async def subscribe_many(
+        self, message: types.Message, entries: list[tuple[str, Optional[str]]]
+    ) -> None:
+        """Validate many subscriptions at once and write them with bulk upserts.
+
+        Replies with a summary of the added, updated and rejected addresses.
+        """
+        user_id = message.from_user.id
+        user_name = message.from_user.username
+        log.info(f"{user_id} {user_name} subscribing to {len(entries)} addresses")
+        thresholds: dict[str, Optional[float]] = {}
+        rejected = []
+        for account_address, alert_threshold in entries:
+            if not is_account_address(account_address):
+                rejected.append(f"{account_address}: invalid address")
+                continue
+            try:
+                thresholds[account_address] = parse_alert_threshold(alert_threshold)
+            except ValueError as e:
+                rejected.append(f"{account_address}: {e}")
+        added: list[str] = []
+        updated: list[str] = []
+        failed: list[str] = []
+        if thresholds:
+            addresses = Address.get_motor_collection()
+            try:
+                await addresses.bulk_write(
+                    [
+                        UpdateOne(
+                            {"account_address": a},
+                            {
+                                "$setOnInsert": {
+                                    "account_address": a,
+                                    "is_staker": False,
+                                }
+                            },
+                            upsert=True,
+                        )
+                        for a in thresholds
+                    ],
+                    ordered=False,
+                )
+            except BulkWriteError as e:
+                # addresses a concurrent upsert inserted first exist all the same
+                errors = e.details["writeErrors"]
+                if any(error["code"] != DUPLICATE_KEY for error in errors):
+                    raise
+            account_addresses = {
+                doc["_id"]: doc["account_address"]
+                async for doc in addresses.find(
+                    {"account_address": {"$in": list(thresholds)}}
+                )
+            }
+            subscriptions = Subscription.get_motor_collection()
+            query = {
+                "address_id": {"$in": list(account_addresses)},
+                "protocol": "anchor",
+                "telegram_id": user_id,
+            }
+            existing = {
+                account_addresses[doc["address_id"]]: doc.get("alert_threshold")
+                async for doc in subscriptions.find(query)
+            }
+            requests, requested = [], []
+            for address_id, account_address in account_addresses.items():
+                threshold = thresholds[account_address]
+                if account_address not in existing:
+                    added.append(account_address)
+                elif existing[account_address] != threshold:
+                    updated.append(account_address)
+                else:
+                    continue
+                requested.append(account_address)
+                requests.append(
+                    UpdateOne(
+                        {
+                            "address_id": address_id,
+                            "protocol": "anchor",
+                            "telegram_id": user_id,
+                        },
+                        {
+                            "$set": {
+                                "alert_threshold": threshold,
+                                "telegram_name": user_name,
+                            }
+                        },
+                        upsert=True,
+                    )
+                )
+            if requests:
+                try:
+                    await subscriptions.bulk_write(requests, ordered=False)
+                except BulkWriteError as e:
+                    # a concurrent subscribe upserted some of them first
+                    for error in e.details["writeErrors"]:
+                        failed.append(requested[error["index"]])
+                    added = [a for a in added if a not in failed]
+                    updated = [a for a in updated if a not in failed]
+                async for doc in subscriptions.find(query):
+                    subscription = Subscription.parse_obj(doc)
+                    self.index.add(
+                        account_addresses[subscription.address_id], subscription
+                    )
+            if updated:
+                await self.redis.delete(*[mute_key(a, user_id) for a in updated])
+        unchanged = len(thresholds) - len(added) - len(updated) - len(failed)
+        reply = (
+            f"added {len(added)}, updated {len(updated)}, "
+            f"unchanged {unchanged}, rejected {len(rejected)}"
+        )
+        reply += f", failed {len(failed)}, retry them\n" if failed else "\n"
+        # the rejected tokens are the user's, the reply is sent as html
+        reply += "".join(f"{quote_html(r)}\n" for r in rejected[:MAX_REJECTED_SHOWN])
+        if len(rejected) > MAX_REJECTED_SHOWN:
+            reply += f"and {len(rejected) - MAX_REJECTED_SHOWN} more\n"
+        await message.reply(reply)
+
     @in_role
     async def list_(self, message: types.Message) -> None:
-        try:
-            await self.dp.throttle("add", rate=1)
-        except Throttled:
+        if not await self.throttler.allow(message.from_user.id, "list"):
             await message.reply("too many requests")
         else:
             user_id = message.from_user.id
             user_name = message.from_user.username
             args = message.get_args().split(" ")
             log.info(f"{user_id} {user_name} {args}")
-            subscriptions = await Subscription.find(
-                Subscription.telegram_id == user_id
-            ).to_list()
-            addresses = [
-                await Address.get(subscription.address_id)
-                for subscription in subscriptions
-            ]
-            ltvs = await asyncio.gather(
-                *[self.terra.ltv(address.account_address) for address in addresses]
-            )
+            subscriptions = self.index.addresses(user_id)
+            with self.terra.interactive():
+                ltvs = await self.ltv_cache.ltv_many(subscriptions)
             reply = ""
-            for index, address in enumerate(addresses):
+            for account_address, subscription in subscriptions.items():
                 url = "{}{}/address/{}".format(
                     FINDER_URL,
-                    self.terra.lcd.chain_id,
-                    address.account_address,
+                    self.terra.pool.chain_id,
+                    account_address,
                 )
-                subscription = subscriptions[index]
-                ltv = ltvs[index]
+                ltv = ltvs.get(account_address)
                 threshold = subscription.alert_threshold or 45
+                if ltv is None:
+                    status = "⚪"
+                elif ltv >= threshold:
+                    status = "🔴"
+                else:
+                    status = "🟢"
                 reply += "{} <a href='{}'>{}...{}</a> {}/{}%\n".format(
-                    "🔴" if ltv >= threshold else "🟢",
+                    status,
                     url,
-                    address.account_address[:13],
-                    address.account_address[-5:],
-                    ltv,
+                    account_address[:13],
+                    account_address[-5:],
+                    "?" if ltv is None else ltv,
                     threshold,
                 )
             await message.reply(reply or "not subscribed to any address")
 
     @in_role
     async def unsubscribe(self, message: types.Message) -> None:
-        try:
-            await self.dp.throttle("add", rate=1)
-        except Throttled:
+        if not await self.throttler.allow(message.from_user.id, "unsubscribe"):
             await message.reply("too many requests")
         else:
             user_id = message.from_user.id
@@ -262,11 +463,12 @@ class Handlers:
                 )
                 if subscription:
                     await subscription.delete()
+                    self.index.remove(address.account_address, user_id)
                     await message.reply(
                         "unsubscribed from "
                         "<a href='{}{}/address/{}'>{}...{}</a>".format(
                             FINDER_URL,
-                            self.terra.lcd.chain_id,
+                            self.terra.pool.chain_id,
                             address.account_address,
                             address.account_address[:13],
                             address.account_address[-5:],
@@ -279,9 +481,27 @@ class Handlers:
 
     @in_role
     async def ltv(self, message: types.Message) -> None:
-        try:
-            await self.dp.throttle("add", rate=1)
-        except Throttled:
+        if not await self.throttler.allow(message.from_user.id, "ltv"):
+            await message.reply("too many requests")
+        else:
+            user_id = message.from_user.id
+            user_name = message.from_user.username
+            args = message.get_args().split(" ")
+            account_address = args[0] if 0 < len(args) else None
+            log.info(f"{user_id} {user_name} {args}")
+            if account_address:
+                with self.terra.interactive():
+                    ltv = await self.ltv_cache.ltv(account_address)
+                if ltv is None:
+                    await message.reply("could not get the ltv, try again later")
+                else:
+                    await message.reply(f"{ltv}%" if ltv else "no loan found")
+            else:
+                await message.reply("invalid format, missing account address")
+
+    @in_role
+    async def ltv_history(self, message: types.Message) -> None:
+        if not await self.throttler.allow(message.from_user.id, "history"):
             await message.reply("too many requests")
         else:
             user_id = message.from_user.id
@@ -290,16 +510,21 @@ class Handlers:
             account_address = args[0] if 0 < len(args) else None
             log.info(f"{user_id} {user_name} {args}")
             if account_address:
-                ltv = await self.terra.ltv(account_address)
-                await message.reply(f"{ltv}%" if ltv else "no loan found")
+                points = await self.history.points(
+                    account_address, time.time() - HISTORY_POINTS * RESOLUTION
+                )
+                reply = "".join(f"{at:%m-%d %H:%M} {ltv}%\n" for at, ltv in points)
+                if len(points) > 1:
+                    hours = (points[-1][0] - points[0][0]).total_seconds() / 3600
+                    trend = (points[-1][1] - points[0][1]) / hours
+                    reply += f"trend: {trend:+.2f}%/h"
+                await message.reply(reply or "no history found")
             else:
                 await message.reply("invalid format, missing account address")
 
     @is_admin
     async def list_users(self, message: types.Message) -> None:
-        try:
-            await self.dp.throttle("add", rate=1)
-        except Throttled:
+        if not await self.throttler.allow(message.from_user.id, "users"):
             await message.reply("too many requests")
             return
         
@@ -337,7 +562,7 @@ class Handlers:
             if not user:
                 user = User(telegram_user=new_user)
                 await user.insert()
-                await self.init_hack()
+                await self.publish_roles()
                 reply = f'User {new_user} can now add alerts.'
             else:
                 reply = f'User {new_user} already exists!'
@@ -370,23 +595,29 @@ class Handlers:
                 Subscription.telegram_name == new_user
             ).to_list()
             log.info(f"remove_user#2")
-            for subscription in enumerate(subscriptions):
+            for subscription in subscriptions:
                 address = await Address.find_one(
                     Address.id == subscription.address_id
                 )
                 log.info(f"remove_user#3")
                 if address is not None:
-                    reply += f"Address {address.account_address} ({str(address.id)}) removed\n"
-                    address.delete()
+                    self.index.remove(address.account_address, subscription.telegram_id)
+                    # the address may still be watched by other users
+                    if not self.index.subscriptions(address.account_address):
+                        reply += (
+                            f"Address {address.account_address} "
+                            f"({str(address.id)}) removed\n"
+                        )
+                        await address.delete()
                 log.info(f"remove_user#4")
                 reply += f"Subscription {str(subscription.address_id)} removed\n"
-                subscription.delete()
+                await subscription.delete()
 
         except Exception as ex:
             log.info(f"remove_user {str(ex)}")
             await message.reply(str(ex))
             return
 
-        await self.init_hack()
+        await self.publish_roles()
 
         await message.reply(f'User {new_user} removed!')
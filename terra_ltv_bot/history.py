@@ -0,0 +1,170 @@
+import logging
+import time
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+from pymongo import ASCENDING, UpdateOne
+
+from .models import LtvSeries
+
+log = logging.getLogger(__name__)
+
+RAW = 0
+# raw samples are bucketed per hour and kept two days, a day after which they
+# are averaged into hourly points bucketed per day
+RAW_BUCKET = 60 * 60
+RAW_RETENTION = 2 * 24 * 60 * 60
+DOWNSAMPLE_AFTER = 24 * 60 * 60
+RESOLUTION = 60 * 60
+BUCKET = 24 * 60 * 60
+# min seconds between two samples of an address
+SAMPLE_INTERVAL = 60
+BULK_SIZE = 1000
+
+
+def _utc(timestamp: float) -> datetime:
+    return datetime.utcfromtimestamp(timestamp)
+
+
+def _timestamp(dt: datetime) -> int:
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+
+def average(
+    offsets: list[int], ltvs: list[float], resolution: int
+) -> list[tuple[int, float]]:
+    """Mean ltv of each `resolution` interval, by interval offset."""
+    sums: dict[int, list[float]] = {}
+    for offset, ltv in zip(offsets, ltvs):
+        total = sums.setdefault(offset - offset % resolution, [0.0, 0])
+        total[0] += ltv
+        total[1] += 1
+    return [(offset, round(s / n, 2)) for offset, (s, n) in sorted(sums.items())]
+
+
+class History:
+    """Ltv samples of every scanned address, in bucketed mongo documents.
+
+    A bucket holds the samples of one address over an interval, so recording
+    a scan batch is one bulk write of `$push` upserts. Retention is enforced
+    by mongo with the buckets `expire_at` ttl index.
+    """
+
+    def __init__(self, retention: int) -> None:
+        self.retention = retention
+        self.last_sample: dict[str, float] = {}
+
+    @staticmethod
+    def _collection() -> Any:
+        return LtvSeries.get_motor_collection()
+
+    async def record(
+        self, ltvs: dict[str, float], now: Optional[float] = None
+    ) -> None:
+        now = now or time.time()
+        start = int(now - now % RAW_BUCKET)
+        requests = []
+        for account_address, ltv in ltvs.items():
+            if now - self.last_sample.get(account_address, 0) < SAMPLE_INTERVAL:
+                continue
+            self.last_sample[account_address] = now
+            requests.append(
+                UpdateOne(
+                    {
+                        "account_address": account_address,
+                        "resolution": RAW,
+                        "start": _utc(start),
+                    },
+                    {
+                        "$push": {"offsets": int(now) - start, "ltvs": ltv},
+                        "$setOnInsert": {"expire_at": _utc(start + RAW_RETENTION)},
+                    },
+                    upsert=True,
+                )
+            )
+        if requests:
+            await self._collection().bulk_write(requests, ordered=False)
+
+    def remove(self, account_address: str) -> None:
+        """Forget the last sample time of an address no longer scanned."""
+        self.last_sample.pop(account_address, None)
+
+    async def downsample(
+        self, owns: Callable[[str], bool], now: Optional[float] = None
+    ) -> int:
+        """Average raw buckets older than a day into hourly points.
+
+        Only the addresses `owns` accepts are downsampled, so sharded
+        scanners do not average the same buckets twice. Returns the number of
+        raw buckets downsampled.
+        """
+        now = now or time.time()
+        collection = self._collection()
+        requests: list[UpdateOne] = []
+        done: list[Any] = []
+        count = 0
+        async for doc in collection.find(
+            {"resolution": RAW, "start": {"$lt": _utc(now - DOWNSAMPLE_AFTER)}}
+        ):
+            if not owns(doc["account_address"]):
+                continue
+            start = _timestamp(doc["start"])
+            bucket = start - start % BUCKET
+            points = average(
+                [start - bucket + o for o in doc["offsets"]], doc["ltvs"], RESOLUTION
+            )
+            requests.append(
+                UpdateOne(
+                    {
+                        "account_address": doc["account_address"],
+                        "resolution": RESOLUTION,
+                        "start": _utc(bucket),
+                    },
+                    {
+                        "$push": {
+                            "offsets": {"$each": [o for o, _ in points]},
+                            "ltvs": {"$each": [ltv for _, ltv in points]},
+                        },
+                        "$setOnInsert": {
+                            "expire_at": _utc(bucket + BUCKET + self.retention)
+                        },
+                    },
+                    upsert=True,
+                )
+            )
+            done.append(doc["_id"])
+            if len(requests) >= BULK_SIZE:
+                count += await self._flush(requests, done)
+                requests, done = [], []
+        if requests:
+            count += await self._flush(requests, done)
+        return count
+
+    async def _flush(self, requests: list[UpdateOne], done: list[Any]) -> int:
+        collection = self._collection()
+        await collection.bulk_write(requests, ordered=False)
+        await collection.delete_many({"_id": {"$in": done}})
+        return len(done)
+
+    async def points(
+        self, account_address: str, since: float, resolution: int = RESOLUTION
+    ) -> list[tuple[datetime, float]]:
+        """Ltvs of an address since `since`, averaged per `resolution`."""
+        offsets: list[int] = []
+        ltvs: list[float] = []
+        cursor = self._collection().find(
+            {
+                "account_address": account_address,
+                "start": {"$gte": _utc(since - since % BUCKET)},
+            }
+        )
+        async for doc in cursor.sort("start", ASCENDING):
+            start = _timestamp(doc["start"])
+            for offset, ltv in zip(doc["offsets"], doc["ltvs"]):
+                if start + offset >= since:
+                    offsets.append(start + offset)
+                    ltvs.append(ltv)
+        return [
+            (_utc(timestamp), ltv)
+            for timestamp, ltv in average(offsets, ltvs, resolution)
+        ]
@@ -0,0 +1,153 @@
+import logging
+from typing import Any, Callable, Optional
+
+from beanie.odm.fields import PydanticObjectId
+from pymongo.errors import PyMongoError
+
+from .models import Address, Subscription
+
+log = logging.getLogger(__name__)
+
+
+class SubscriptionIndex:
+    """In process index of subscriptions by address and by telegram user.
+
+    Loaded once at startup, then kept up to date by the handlers and, when
+    mongo runs as a replica set, by a change stream on subscriptions so
+    changes made by other replicas are seen too.
+    """
+
+    def __init__(self) -> None:
+        self.by_address: dict[str, dict[int, Subscription]] = {}
+        self.by_telegram_id: dict[int, dict[str, Subscription]] = {}
+        self.address_ids: dict[str, PydanticObjectId] = {}
+        self.account_addresses: dict[PydanticObjectId, str] = {}
+        self.by_id: dict[Any, tuple[str, int]] = {}
+        self.changed: set[str] = set()
+        # changes made while loading, replayed on the loaded index
+        self._journal: Optional[list[Callable[["SubscriptionIndex"], None]]] = None
+
+    async def load(self) -> None:
+        # built aside and swapped in, the scan keeps using the current index
+        # while it loads
+        index = SubscriptionIndex()
+        self._journal = []
+        try:
+            async for address in Address.find_all():
+                index._add_address(address)
+            async for subscription in Subscription.find_all():
+                account_address = index.account_addresses.get(subscription.address_id)
+                if account_address:
+                    index.add(account_address, subscription)
+            # the loaded documents may predate them
+            for change in self._journal:
+                change(index)
+        finally:
+            self._journal = None
+        self.changed.update(self.by_address, index.changed)
+        self.by_address = index.by_address
+        self.by_telegram_id = index.by_telegram_id
+        self.address_ids = index.address_ids
+        self.account_addresses = index.account_addresses
+        self.by_id = index.by_id
+        log.info(
+            f"indexed {len(self.by_address)} addresses "
+            f"for {len(self.by_telegram_id)} users"
+        )
+
+    def _add_address(self, address: Address) -> None:
+        if address.id is not None:
+            self.address_ids[address.account_address] = address.id
+            self.account_addresses[address.id] = address.account_address
+
+    def add(self, account_address: str, subscription: Subscription) -> None:
+        self.address_ids.setdefault(account_address, subscription.address_id)
+        self.account_addresses.setdefault(subscription.address_id, account_address)
+        self.by_address.setdefault(account_address, {})[
+            subscription.telegram_id
+        ] = subscription
+        self.by_telegram_id.setdefault(subscription.telegram_id, {})[
+            account_address
+        ] = subscription
+        self.by_id[subscription.id] = (account_address, subscription.telegram_id)
+        self.changed.add(account_address)
+        if self._journal is not None:
+            self._journal.append(
+                lambda index: index.add(account_address, subscription)
+            )
+
+    def remove(self, account_address: str, telegram_id: int) -> None:
+        subscriptions = self.by_address.get(account_address, {})
+        subscription = subscriptions.pop(telegram_id, None)
+        if subscription is not None:
+            self.by_id.pop(subscription.id, None)
+        if not subscriptions:
+            self.by_address.pop(account_address, None)
+        addresses = self.by_telegram_id.get(telegram_id, {})
+        addresses.pop(account_address, None)
+        if not addresses:
+            self.by_telegram_id.pop(telegram_id, None)
+        self.changed.add(account_address)
+        if self._journal is not None:
+            self._journal.append(
+                lambda index: index.remove(account_address, telegram_id)
+            )
+
+    def dump(self) -> dict[str, Any]:
+        return dict(
+            addresses=self.address_ids,
+            subscriptions=[
+                (account_address, subscription.dict())
+                for account_address, subscriptions in self.by_address.items()
+                for subscription in subscriptions.values()
+            ],
+        )
+
+    def restore(self, dump: dict[str, Any]) -> None:
+        """Index a `dump`, until the next `load` catches up with mongo."""
+        for account_address, address_id in dump["addresses"].items():
+            address_id = PydanticObjectId(address_id)
+            self.address_ids[account_address] = address_id
+            self.account_addresses[address_id] = account_address
+        for account_address, subscription in dump["subscriptions"]:
+            self.add(account_address, Subscription.parse_obj(subscription))
+
+    def subscriptions(self, account_address: str) -> list[Subscription]:
+        return list(self.by_address.get(account_address, {}).values())
+
+    def addresses(self, telegram_id: int) -> dict[str, Subscription]:
+        return dict(self.by_telegram_id.get(telegram_id, {}))
+
+    def address_id(self, account_address: str) -> Optional[PydanticObjectId]:
+        return self.address_ids.get(account_address)
+
+    def drain_changes(self) -> set[str]:
+        changed, self.changed = self.changed, set()
+        return changed
+
+    async def watch(self) -> None:
+        """Follow subscription changes made anywhere, needs a replica set."""
+        collection = Subscription.get_motor_collection()
+        try:
+            async with collection.watch(full_document="updateLookup") as stream:
+                async for change in stream:
+                    await self._apply(change)
+        except PyMongoError as e:
+            log.warning(f"subscriptions change stream unavailable: {e}")
+
+    async def _apply(self, change: dict) -> None:
+        operation = change["operationType"]
+        found = self.by_id.get(change["documentKey"]["_id"])
+        if found:
+            self.remove(*found)
+        if operation == "delete" or not change.get("fullDocument"):
+            return
+        subscription = Subscription.parse_obj(change["fullDocument"])
+        account_address = self.account_addresses.get(subscription.address_id)
+        if account_address is None:
+            address = await Address.get(subscription.address_id)
+            if address is None:
+                return
+            self._add_address(address)
+            account_address = address.account_address
+        self.add(account_address, subscription)
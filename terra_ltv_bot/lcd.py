@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Optional, TypeVar
+
+from aiohttp import ClientError
+from terra_sdk.exceptions import LCDResponseError
+
+from .limiter import BACKGROUND, TIERS, PriorityLimiter
+from .metrics import LCD_ENDPOINT_RATE
+
+if TYPE_CHECKING:
+    from terra_sdk.client.lcd.lcdclient import AsyncLCDClient
+
+    from .rawlcd import RawLCD
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# requests per second of an endpoint, adapted between these bounds
+INITIAL_RATE = 20
+MIN_RATE = 1
+MAX_RATE = 200
+RATE_INCREASE = 0.5
+RATE_DECREASE = 0.5
+# consecutive failures before an endpoint is taken out of rotation
+EJECT_AFTER = 3
+EJECT_TIME = 30
+TIMEOUT = 10
+LATENCY_WEIGHT = 0.2
+# statuses meaning the node, not the query, failed: rate limited or the
+# gateway in front of it has no healthy node behind
+ENDPOINT_FAILURES = {429, 502, 503, 504}
+
+
+class LCDUnavailable(LCDResponseError):
+    """Every endpoint failed a request, raised as a response error so callers
+    handle it like a failed query."""
+
+    def __init__(self, error: Exception) -> None:
+        super().__init__(message=repr(error), response=None)
+        self.error = error
+
+    def __str__(self) -> str:
+        return f"every endpoint failed - {self.message}"
+
+
+class Endpoint:
+    """One LCD with its own connection pool and adaptive rate limit.
+
+    The rate grows additively on success and is halved when the node rate
+    limits us or times out (AIMD). Requests wait for their turn by limiter
+    tier, so interactive ones overtake a background backlog.
+    """
+
+    def __init__(self, url: str, chain_id: str) -> None:
+        self.url = url
+        self.chain_id = chain_id
+        self._lcd: Optional["AsyncLCDClient"] = None
+        self._raw: Optional["RawLCD"] = None
+        self.limiter = PriorityLimiter(rate=INITIAL_RATE, burst=1, reserve=0)
+        self.latency = 0.0
+        self.in_flight = 0
+        self.failures = 0
+        self.ejections = 0
+        self.down_until = 0.0
+
+    @property
+    def lcd(self) -> "AsyncLCDClient":
+        if self._lcd is None:
+            # the client pulls in most of the sdk, only import it once used
+            from terra_sdk.client.lcd.lcdclient import AsyncLCDClient
+
+            self._lcd = AsyncLCDClient(url=self.url, chain_id=self.chain_id)
+        return self._lcd
+
+    @property
+    def raw(self) -> "RawLCD":
+        if self._raw is None:
+            # ujson is only required for raw queries
+            from .rawlcd import RawLCD
+
+            self._raw = RawLCD(self.url)
+        return self._raw
+
+    @property
+    def rate(self) -> float:
+        return self.limiter.rate
+
+    @rate.setter
+    def rate(self, rate: float) -> None:
+        self.limiter.set_rate(rate)
+        LCD_ENDPOINT_RATE.set(rate, endpoint=self.url)
+
+    def healthy(self, now: float) -> bool:
+        return self.down_until <= now
+
+    def cost(self, tier: str = BACKGROUND) -> float:
+        """Expected seconds before a request of `tier` sent here now would
+        complete, only the requests of its tier and higher ones go first."""
+        ahead = sum(self.limiter.depth(t) for t in TIERS[: TIERS.index(tier) + 1])
+        return ahead / self.rate + self.latency * (1 + self.in_flight)
+
+    async def acquire(self, tier: str = BACKGROUND) -> None:
+        await self.limiter.acquire(tier)
+
+    def succeeded(self, latency: float) -> None:
+        self.latency += LATENCY_WEIGHT * (latency - self.latency)
+        self.rate = min(MAX_RATE, self.rate + RATE_INCREASE)
+        self.failures = 0
+        self.ejections = 0
+
+    def failed(self) -> None:
+        self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+        self.failures += 1
+        if self.failures >= EJECT_AFTER:
+            self.ejections += 1
+            eject_time = EJECT_TIME * 2 ** min(self.ejections - 1, 5)
+            self.down_until = time.monotonic() + eject_time
+            self.failures = 0
+            log.warning(f"{self.url} out of rotation for {eject_time}s")
+
+
+class LCDPool:
+    """Routes LCD requests to the fastest healthy endpoint.
+
+    Requests failing because of the node (rate limited, gateway errors, timed
+    out or unreachable) are retried on the next best endpoint, `LCDUnavailable`
+    is raised once every endpoint failed.
+    """
+
+    def __init__(self, urls: list[str], chain_id: str) -> None:
+        self.endpoints = [Endpoint(url, chain_id) for url in urls]
+        self.chain_id = chain_id
+
+    def __len__(self) -> int:
+        return len(self.endpoints)
+
+    def pick(self, exclude: list[Endpoint], tier: str = BACKGROUND) -> Endpoint:
+        now = time.monotonic()
+        candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+        healthy = [e for e in candidates if e.healthy(now)]
+        if not healthy:
+            return min(candidates, key=lambda e: e.down_until)
+        return min(healthy, key=lambda e: e.cost(tier))
+
+    async def close(self) -> None:
+        for endpoint in self.endpoints:
+            if endpoint._raw is not None:
+                await endpoint._raw.close()
+
+    async def request(
+        self,
+        f: Callable[[Any], Awaitable[T]],
+        raw: bool = False,
+        tier: str = BACKGROUND,
+    ) -> T:
+        """Call `f` with the best endpoint sdk client, or its `RawLCD` if `raw`,
+        waiting for an endpoint slot in the limiter `tier`."""
+        tried: list[Endpoint] = []
+        while True:
+            endpoint = self.pick(tried, tier)
+            tried.append(endpoint)
+            await endpoint.acquire(tier)
+            endpoint.in_flight += 1
+            start = time.monotonic()
+            try:
+                client = endpoint.raw if raw else endpoint.lcd
+                result = await asyncio.wait_for(f(client), TIMEOUT)
+            except LCDResponseError as e:
+                if e.response.status not in ENDPOINT_FAILURES:
+                    # the node answered, the query itself failed
+                    endpoint.succeeded(time.monotonic() - start)
+                    raise
+                error: Exception = e
+            except (asyncio.TimeoutError, ClientError) as e:
+                error = e
+            else:
+                endpoint.succeeded(time.monotonic() - start)
+                return result
+            finally:
+                endpoint.in_flight -= 1
+            endpoint.failed()
+            log.info(f"{endpoint.url} failed: {error!r}")
+            if len(tried) >= len(self.endpoints):
+                raise LCDUnavailable(error) from error
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+# highest priority first
+TIERS = (INTERACTIVE, BACKGROUND)
+
+
+class PriorityLimiter:
+    """Token bucket shared by interactive and background callers.
+
+    Interactive callers are served first and may use every token, background
+    callers leave `reserve` tokens in the bucket and wait while any
+    interactive caller does, so a scan backlog never delays a command.
+    """
+
+    def __init__(self, rate: float, burst: float, reserve: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.waiters: dict[str, deque[asyncio.Future]] = {t: deque() for t in TIERS}
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    def depth(self, tier: str) -> int:
+        # cancelled waiters are only dropped once they reach the front
+        return len(self.waiters[tier])
+
+    def _floor(self, tier: str) -> float:
+        return 0 if tier == INTERACTIVE else self.reserve
+
+    def set_rate(self, rate: float) -> None:
+        # tokens accrued so far count at the previous rate
+        self._refill()
+        self.rate = rate
+        self._grant()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _grant(self) -> None:
+        self._refill()
+        waiting: Optional[str] = None
+        for tier in TIERS:
+            waiters = self.waiters[tier]
+            while waiters:
+                if waiters[0].done():
+                    waiters.popleft()
+                elif self.tokens - 1 >= self._floor(tier):
+                    self.tokens -= 1
+                    waiters.popleft().set_result(None)
+                else:
+                    break
+            if waiters:
+                waiting = tier
+                # lower tiers wait for this one
+                break
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        if waiting is not None:
+            missing = 1 + self._floor(waiting) - self.tokens
+            self._wakeup = asyncio.get_event_loop().call_later(
+                max(0.0, missing / self.rate), self._grant
+            )
+
+    async def acquire(self, tier: str = BACKGROUND) -> None:
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[tier].append(future)
+        self._grant()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # granted as we were cancelled, give the token back
+                self.tokens += 1
+                self._grant()
+            raise
@@ -0,0 +1,154 @@
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional, Tuple
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format(labels: Labels, extra: Optional[tuple[str, str]] = None) -> str:
+    pairs = [*labels, extra] if extra else list(labels)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        registry.append(self)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        return super().render() + [
+            f"{self.name}{_format(labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_labels(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> None:
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.counts: dict[Labels, list[int]] = {}
+        self.sums: dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                total += count
+                le = ("le", str(bound))
+                lines.append(f"{self.name}_bucket{_format(labels, le)} {total}")
+            lines.append(f"{self.name}_sum{_format(labels)} {self.sums[labels]}")
+            lines.append(f"{self.name}_count{_format(labels)} {total}")
+        return lines
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+SCAN_CYCLE_SECONDS = Histogram("scan_cycle_seconds", "Duration of a scan tick")
+SCAN_ADDRESSES = Counter("scan_addresses_total", "Addresses whose ltv was checked")
+LCD_QUERY_SECONDS = Histogram("lcd_query_seconds", "LCD query latency by query")
+LCD_ERRORS = Counter("lcd_errors_total", "Failed LCD queries by query")
+LCD_ENDPOINT_RATE = Gauge("lcd_endpoint_rate", "Adaptive rate limit per endpoint")
+LIMITER_WAIT_SECONDS = Histogram(
+    "lcd_limiter_wait_seconds", "Time spent waiting for the LCD rate limiter by tier"
+)
+LIMITER_QUEUE_DEPTH = Gauge(
+    "lcd_limiter_queue_depth", "Callers waiting for the LCD rate limiter by tier"
+)
+LTV_CACHE = Counter("ltv_cache_total", "Ltv cache lookups by result")
+LTV_COALESCED = Counter("ltv_coalesced_total", "Ltv calls joining one in flight")
+ALERTS = Counter("alerts_total", "Alerts by status")
+OUTBOX_MESSAGES = Counter("outbox_messages_total", "Outbox messages by status")
+COMMAND_SECONDS = Histogram("command_seconds", "Command handling latency")
+
+
+async def serve(host: str, port: int) -> None:
+    """Expose the metrics in prometheus text format on /metrics."""
+
+    async def handle(_: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"serving metrics on {host}:{port}")
+
+
+class CommandMetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data["started"] = time.perf_counter()
+
+    async def on_post_process_message(
+        self, message: types.Message, results: list[Any], data: dict
+    ):
+        command = message.get_command(pure=True)
+        if command and "started" in data:
+            COMMAND_SECONDS.observe(
+                time.perf_counter() - data["started"], command=command
+            )
@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Any, Optional
 
 from beanie import Document, Indexed
@@ -8,6 +9,18 @@ from pymongo import ASCENDING, IndexModel
 from .terra import is_account_address
 
 
+def parse_alert_threshold(v: Any) -> Optional[float]:
+    if v is None:
+        return v
+    try:
+        threshold = float(v)
+    except ValueError:
+        raise ValueError("alert threshold is not a float")
+    if not 0 <= threshold <= 100:
+        raise ValueError("alert threshold is not a percentage")
+    return threshold
+
+
 class Address(Document):
     account_address: Indexed(str, unique=True)  # type: ignore
     is_staker: bool = False
@@ -46,15 +59,7 @@ class Subscription(Document):
 
     @validator("alert_threshold", always=True)
     def alert_threshold_is_percentage(cls, v: Any) -> Optional[float]:
-        if v is None:
-            return v
-        try:
-            threshold = float(v)
-        except ValueError:
-            raise ValueError("alert threshold is not a float")
-        if not 0 <= threshold <= 100:
-            raise ValueError("alert threshold is not a percentage")
-        return threshold
+        return parse_alert_threshold(v)
 
 
 class User(Document):
@@ -68,4 +73,33 @@ class User(Document):
         return v
 
 
-all_models = [Address, Subscription, User]
+class LtvSeries(Document):
+    """Bucket of ltv samples of an address, starting at `start`.
+
+    `resolution` is 0 for raw samples, otherwise the seconds each downsampled
+    point averages. Points are stored as offsets in seconds from `start` and
+    ltvs in parallel arrays, and mongo drops the bucket at `expire_at`.
+    """
+
+    account_address: str
+    resolution: int
+    start: datetime
+    expire_at: datetime
+    offsets: list[int] = []
+    ltvs: list[float] = []
+
+    class Collection:
+        indexes = [
+            IndexModel(
+                [
+                    ("account_address", ASCENDING),
+                    ("resolution", ASCENDING),
+                    ("start", ASCENDING),
+                ],
+                unique=True,
+            ),
+            IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0),
+        ]
+
+
+all_models = [Address, Subscription, User, LtvSeries]
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.utils.exceptions import (
+    BadRequest,
+    RetryAfter,
+    TelegramAPIError,
+    Unauthorized,
+)
+from aioredis import Redis
+from aioredis.client import Pipeline
+
+from .metrics import OUTBOX_MESSAGES
+
+log = logging.getLogger(__name__)
+
+_outbox_key = "outbox:messages"
+_processing_key = "outbox:processing"
+_rate_key = "outbox:rate"
+_chat_key = "outbox:chat:{}"
+_paused_key = "outbox:paused"
+# telegram allows ~30 messages per second overall and 1 per second per chat
+GLOBAL_RATE = 30
+CHAT_INTERVAL = 1
+MAX_ATTEMPTS = 5
+# seconds after which a message still being processed was lost by its worker
+REQUEUE_AFTER = 5 * 60
+
+# seconds to wait before sending to the chat in KEYS[2], 0 once allowed: the
+# global token bucket in KEYS[1] and the chat next send time must both allow
+# it and sends must not be paused by KEYS[3]
+_send_slot_script = """
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local chat_interval = tonumber(ARGV[3])
+local paused = tonumber(redis.call("get", KEYS[3]) or 0)
+if paused > now then
+    return tostring(paused - now)
+end
+local chat_at = tonumber(redis.call("get", KEYS[2]) or 0)
+if chat_at > now then
+    return tostring(chat_at - now)
+end
+local bucket = redis.call("hmget", KEYS[1], "tokens", "at")
+local tokens = tonumber(bucket[1]) or rate
+local at = tonumber(bucket[2]) or now
+tokens = math.min(rate, tokens + math.max(0, now - at) * rate)
+if tokens < 1 then
+    return tostring((1 - tokens) / rate)
+end
+redis.call("hset", KEYS[1], "tokens", tostring(tokens - 1), "at", tostring(now))
+redis.call("expire", KEYS[1], 2)
+if chat_interval > 0 then
+    local px = math.ceil(chat_interval * 1000)
+    redis.call("set", KEYS[2], tostring(now + chat_interval), "px", px)
+end
+return "0"
+"""
+
+
+class Outbox:
+    """Redis backed queue of telegram messages drained by concurrent workers.
+
+    Queued messages survive restarts, and so do the ones being sent: workers
+    move a message to a processing list until it is sent, and messages a
+    crashed process left there are queued again at startup. Workers of every
+    replica keep to telegram's global and per chat limits together, those are
+    kept in redis, pause all sends on `RetryAfter` and retry other transient
+    errors with a backoff.
+    """
+
+    def __init__(self, bot: Bot, redis: Redis, workers: int) -> None:
+        self.bot = bot
+        self.redis = redis
+        self.workers = workers
+        self.rate = GLOBAL_RATE
+        self.chat_interval = CHAT_INTERVAL
+
+    def push(self, pipe: Pipeline, chat_id: int, text: str) -> None:
+        """Queue a message as part of the caller's pipeline."""
+        pipe.rpush(_outbox_key, json.dumps(dict(chat_id=chat_id, text=text)))
+
+    async def put(self, chat_id: int, text: str) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            self.push(pipe, chat_id, text)
+            await pipe.execute()
+
+    async def run(self) -> None:
+        await asyncio.gather(
+            self.requeue(), *[self.worker() for _ in range(self.workers)]
+        )
+
+    async def requeue(self) -> None:
+        """Queue again the messages a crashed process took but never sent.
+
+        Other replicas may be sending some of them, those are removed from the
+        processing list once sent, so only the ones still there after
+        `REQUEUE_AFTER` are queued again.
+        """
+        taken = await self.redis.lrange(_processing_key, 0, -1)
+        if not taken:
+            return
+        await asyncio.sleep(REQUEUE_AFTER)
+        requeued = 0
+        # in front of the queue, oldest first
+        for raw in reversed(taken):
+            if await self.redis.lrem(_processing_key, 1, raw):
+                await self.redis.lpush(_outbox_key, raw)
+                requeued += 1
+        if requeued:
+            log.warning(f"requeued {requeued} messages left unsent")
+
+    async def worker(self) -> None:
+        while True:
+            # aioredis has no blmove helper
+            raw = await self.redis.execute_command(
+                "BLMOVE", _outbox_key, _processing_key, "LEFT", "RIGHT", 0
+            )
+            if raw is None:
+                continue
+            try:
+                await self.send(json.loads(raw))
+            except asyncio.CancelledError:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    pipe.lpush(_outbox_key, raw)
+                    pipe.lrem(_processing_key, 1, raw)
+                    await pipe.execute()
+                raise
+            except Exception as e:
+                log.error(f"exception in outbox: {e}", stack_info=True)
+            await self.redis.lrem(_processing_key, 1, raw)
+
+    async def _wait_for_slot(self, chat_id: int) -> None:
+        while True:
+            wait = await self.redis.eval(
+                _send_slot_script,
+                3,
+                _rate_key,
+                _chat_key.format(chat_id),
+                _paused_key,
+                time.time(),
+                self.rate,
+                self.chat_interval,
+            )
+            if float(wait) <= 0:
+                return
+            await asyncio.sleep(float(wait))
+
+    async def send(self, message: dict) -> None:
+        chat_id = message["chat_id"]
+        attempts = message.get("attempts", 0) + 1
+        await self._wait_for_slot(chat_id)
+        try:
+            await self.bot.send_message(chat_id, message["text"])
+            OUTBOX_MESSAGES.inc(status="sent")
+            return
+        except RetryAfter as e:
+            OUTBOX_MESSAGES.inc(status="rate_limited")
+            log.warning(f"telegram flood control, pausing sends for {e.timeout}s")
+            await self.redis.set(
+                _paused_key, time.time() + e.timeout, px=int(e.timeout * 1000)
+            )
+            await self.redis.lpush(_outbox_key, json.dumps(message))
+            return
+        except (Unauthorized, BadRequest) as e:
+            OUTBOX_MESSAGES.inc(status="failed")
+            log.warning(f"Couldn't send message to {chat_id}: {e}")
+            return
+        except (TelegramAPIError, asyncio.TimeoutError) as e:
+            if attempts >= MAX_ATTEMPTS:
+                OUTBOX_MESSAGES.inc(status="failed")
+                log.warning(
+                    f"Couldn't send message to {chat_id} after {attempts} tries: {e}"
+                )
+                return
+            OUTBOX_MESSAGES.inc(status="retried")
+            log.info(f"retrying message to {chat_id} ({attempts}): {e!r}")
+        await asyncio.sleep(2 ** attempts)
+        await self.redis.rpush(
+            _outbox_key, json.dumps(dict(message, attempts=attempts))
+        )
@@ -0,0 +1,140 @@
+import logging
+from decimal import Decimal
+from typing import Iterable
+
+import numpy as np
+from terra_sdk.exceptions import LCDResponseError
+
+from .terra import Terra
+
+log = logging.getLogger(__name__)
+
+
+class Positions:
+    """Borrower loans and collaterals kept in numpy arrays.
+
+    Between loan or collateral changes an ltv only moves with the oracle
+    prices and the interest accrued on the loan, so positions are only queried
+    for new or invalidated addresses and every ltv is recomputed from the
+    latest prices and market interest index in one vectorized pass, the same
+    way the overseer computes `borrow_limit`. Rows of removed addresses are
+    reused.
+    """
+
+    def __init__(self, terra: Terra, capacity: int = 1024) -> None:
+        self.terra = terra
+        self.rows: dict[str, int] = {}
+        self.tokens: dict[str, int] = {}
+        self.stale: set[str] = set()
+        self.free: list[int] = []
+        self.prices: dict[str, Decimal] = {}
+        self.max_ltvs: dict[str, Decimal] = {}
+        self.interest_index = 1.0
+        # loans per unit of the market global interest index
+        self.loans = np.zeros(capacity)
+        self.collaterals = np.zeros((capacity, 0))
+
+    def invalidate(self, account_addresses: Iterable[str]) -> None:
+        self.stale.update(a for a in account_addresses if a in self.rows)
+
+    def remove(self, account_addresses: Iterable[str]) -> None:
+        for account_address in account_addresses:
+            row = self.rows.pop(account_address, None)
+            if row is not None:
+                self.loans[row] = 0
+                self.collaterals[row] = 0
+                self.stale.discard(account_address)
+                self.free.append(row)
+
+    def _row(self, account_address: str) -> int:
+        row = self.rows.get(account_address)
+        if row is None:
+            if self.free:
+                row = self.free.pop()
+            else:
+                row = len(self.rows)
+                if row == len(self.loans):
+                    self.loans = np.concatenate([self.loans, np.zeros(row)])
+                    self.collaterals = np.vstack(
+                        [self.collaterals, np.zeros(self.collaterals.shape)]
+                    )
+            self.rows[account_address] = row
+        return row
+
+    def _column(self, token: str) -> int:
+        column = self.tokens.get(token)
+        if column is None:
+            column = len(self.tokens)
+            self.collaterals = np.hstack(
+                [self.collaterals, np.zeros((len(self.collaterals), 1))]
+            )
+            self.tokens[token] = column
+        return column
+
+    async def refresh(self, account_addresses: Iterable[str]) -> None:
+        positions = await self.terra.positions(account_addresses)
+        for account_address, (loan, collaterals) in positions.items():
+            row = self._row(account_address)
+            self.loans[row] = loan
+            self.collaterals[row] = 0
+            for token, amount in collaterals:
+                # a new token column replaces the array, index it afterwards
+                column = self._column(token)
+                self.collaterals[row, column] = amount
+            self.stale.discard(account_address)
+        log.debug(f"refreshed {len(positions)} positions")
+
+    async def update_prices(self) -> None:
+        interest_index, self.max_ltvs, self.prices = await self.terra.market()
+        self.interest_index = float(interest_index)
+
+    def position(self, account_address: str) -> tuple[float, dict[str, float]]:
+        """Loan and collateral amounts times their max ltv by token."""
+        row = self.rows[account_address]
+        weights = {}
+        for token, column in self.tokens.items():
+            amount = float(self.collaterals[row, column])
+            if amount:
+                weights[token] = amount * float(self.max_ltvs.get(token, 0))
+        return float(self.loans[row]) * self.interest_index, weights
+
+    async def ltv_many(
+        self, account_addresses: Iterable[str], update_prices: bool = True
+    ) -> dict[str, float]:
+        """Ltvs of addresses, `update_prices=False` reuses the last prices.
+
+        Addresses whose position could not be queried are left out.
+        """
+        account_addresses = list(dict.fromkeys(account_addresses))
+        if not account_addresses:
+            return {}
+        outdated = [
+            a for a in account_addresses if a not in self.rows or a in self.stale
+        ]
+        try:
+            if outdated:
+                await self.refresh(outdated)
+            if update_prices or not self.prices:
+                await self.update_prices()
+        except LCDResponseError as e:
+            log.warning(f"Could not refresh positions or prices: {e}")
+            return await self.terra.ltv_many(account_addresses)
+        # positions in pages that failed are left out
+        account_addresses = [
+            a for a in account_addresses if a in self.rows and a not in self.stale
+        ]
+        weights = np.zeros(len(self.tokens))
+        for token, column in self.tokens.items():
+            weights[column] = float(
+                self.prices.get(token, 0) * self.max_ltvs.get(token, 0)
+            )
+        rows = np.fromiter(
+            (self.rows[a] for a in account_addresses),
+            dtype=np.intp,
+            count=len(account_addresses),
+        )
+        limits = np.floor(self.collaterals[rows] @ weights)
+        ltvs = np.zeros(len(rows))
+        loans = np.floor(self.loans[rows] * self.interest_index)
+        np.divide(loans * 60, limits, out=ltvs, where=limits > 0)
+        return dict(zip(account_addresses, ltvs.round(2).tolist()))
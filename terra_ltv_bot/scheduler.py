@@ -0,0 +1,165 @@
+import heapq
+import logging
+from typing import Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+# ltv points from the threshold under which an address is checked every block
+NEAR_THRESHOLD = 5
+# share of the per tick budget kept for the addresses far from their threshold
+# while near ones are due
+FAR_SHARE = 0.2
+
+
+class Scheduler:
+    """Priority queue of addresses ordered by their next check time.
+
+    The closer an address ltv is to its lowest subscription threshold the
+    sooner it is checked again, down to every block once it is within
+    `NEAR_THRESHOLD` points. At most `budget` addresses per second are handed
+    out, the most overdue first. Addresses near their threshold, new or bumped
+    are queued apart and served before the others, which still get
+    `FAR_SHARE` of the budget, so a saturated budget goes where the risk is.
+    """
+
+    def __init__(self, block_time: float, max_interval: float, budget: float) -> None:
+        self.block_time = block_time
+        self.max_interval = max_interval
+        self.per_tick = max(1, int(budget * block_time))
+        self.thresholds: dict[str, float] = {}
+        self.next_check: dict[str, float] = {}
+        self.ltvs: dict[str, float] = {}
+        self.near: set[str] = set()
+        self._heap: list[tuple[float, str]] = []
+        self._near_heap: list[tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.thresholds)
+
+    def is_near(self, account_address: str) -> bool:
+        ltv = self.ltvs.get(account_address)
+        threshold = self.thresholds.get(account_address)
+        if ltv is None or threshold is None:
+            return True
+        return threshold - ltv <= NEAR_THRESHOLD
+
+    def _push(
+        self, account_address: str, when: float, near: Optional[bool] = None
+    ) -> None:
+        self.next_check[account_address] = when
+        if near is None:
+            near = self.is_near(account_address)
+        if near:
+            self.near.add(account_address)
+            heapq.heappush(self._near_heap, (when, account_address))
+        else:
+            self.near.discard(account_address)
+            heapq.heappush(self._heap, (when, account_address))
+
+    def track(self, account_address: str, threshold: float, now: float) -> None:
+        """Track an address or update its lowest threshold.
+
+        New addresses and lowered thresholds are checked right away.
+        """
+        previous = self.thresholds.get(account_address)
+        self.thresholds[account_address] = threshold
+        if previous is None or threshold < previous:
+            self._push(account_address, now)
+
+    def bump(self, account_addresses: Iterable[str], now: float) -> int:
+        """Check tracked addresses before any other, returns how many."""
+        bumped = 0
+        for account_address in account_addresses:
+            if account_address in self.thresholds:
+                self._push(account_address, now - self.max_interval, near=True)
+                bumped += 1
+        return bumped
+
+    def untrack(self, account_address: str) -> None:
+        self.thresholds.pop(account_address, None)
+        self.next_check.pop(account_address, None)
+        self.ltvs.pop(account_address, None)
+        self.near.discard(account_address)
+
+    def interval(self, ltv: float, threshold: float) -> float:
+        gap = threshold - ltv
+        if gap <= NEAR_THRESHOLD:
+            return self.block_time
+        return min(self.block_time * (gap / NEAR_THRESHOLD) ** 2, self.max_interval)
+
+    def schedule(self, account_address: str, ltv: float, now: float) -> None:
+        threshold = self.thresholds.get(account_address)
+        if threshold is None:
+            return
+        self.ltvs[account_address] = ltv
+        self._push(account_address, now + self.interval(ltv, threshold))
+
+    def retry(self, account_addresses: Iterable[str], now: float) -> None:
+        """Check tracked addresses whose check failed again on the next block."""
+        for account_address in account_addresses:
+            if account_address in self.thresholds:
+                self._push(account_address, now + self.block_time)
+
+    def due(self, now: float, limit: Optional[int] = None) -> list[str]:
+        """Pop the addresses to check now, within the per tick budget.
+
+        They are tentatively rescheduled for the next block in case their
+        check fails, `schedule` overrides it with their new ltv.
+        """
+        limit = self.per_tick if limit is None else limit
+        reserve = int(limit * FAR_SHARE)
+        addresses = self._pop(self._near_heap, True, now, limit - reserve)
+        addresses += self._pop(self._heap, False, now, limit - len(addresses))
+        # far addresses left some of their share unused
+        addresses += self._pop(self._near_heap, True, now, limit - len(addresses))
+        for account_address in addresses:
+            self._push(account_address, now + self.block_time)
+        if len(self._heap) + len(self._near_heap) > 2 * len(self.next_check) + 64:
+            self._compact()
+        return addresses
+
+    def _pop(
+        self, heap: list[tuple[float, str]], near: bool, now: float, limit: int
+    ) -> list[str]:
+        addresses: list[str] = []
+        while heap and len(addresses) < limit and heap[0][0] <= now:
+            when, account_address = heapq.heappop(heap)
+            if (
+                self.next_check.get(account_address) != when
+                or (account_address in self.near) != near
+            ):
+                continue
+            del self.next_check[account_address]
+            addresses.append(account_address)
+        return addresses
+
+    def dump(self, now: float) -> dict[str, tuple[float, float, Optional[float]]]:
+        """Threshold, seconds to the next check and last ltv of each address."""
+        return {
+            account_address: (
+                self.thresholds[account_address],
+                when - now,
+                self.ltvs.get(account_address),
+            )
+            for account_address, when in self.next_check.items()
+        }
+
+    def restore(
+        self, schedule: dict[str, tuple[float, float, Optional[float]]], now: float
+    ) -> None:
+        """Track addresses from a `dump` taken at `now`."""
+        for account_address, (threshold, delay, ltv) in schedule.items():
+            self.thresholds[account_address] = threshold
+            if ltv is not None:
+                self.ltvs[account_address] = ltv
+            self._push(account_address, now + delay)
+
+    def _compact(self) -> None:
+        self._heap = [
+            (when, a) for a, when in self.next_check.items() if a not in self.near
+        ]
+        self._near_heap = [
+            (when, a) for a, when in self.next_check.items() if a in self.near
+        ]
+        heapq.heapify(self._heap)
+        heapq.heapify(self._near_heap)
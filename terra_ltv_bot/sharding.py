@@ -0,0 +1,108 @@
+import logging
+import os
+import socket
+import time
+import zlib
+from typing import Any
+
+from aioredis import Redis
+
+log = logging.getLogger(__name__)
+
+_workers_key = "scanner:workers"
+_lease_key = "scanner:lease:{}"
+
+# only touch a lease if it is still ours
+_renew_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+_release_script = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def shard_of(address_id: Any, shard_count: int) -> int:
+    return zlib.crc32(str(address_id).encode()) % shard_count
+
+
+class Shards:
+    """Splits addresses between scanner workers with redis leases.
+
+    Addresses are hashed into `shard_count` shards. Workers register with a
+    heartbeat and each takes a contiguous range of shards according to its
+    rank among live workers. A shard lease is exclusive and has to be released
+    (or expire, if its worker died) before another worker can take it, so an
+    address is never scanned by two workers at once.
+    """
+
+    def __init__(self, redis: Redis, shard_count: int, lease_ttl: int) -> None:
+        self.redis = redis
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.owned: set[int] = set()
+
+    def owns(self, address_id: Any) -> bool:
+        return shard_of(address_id, self.shard_count) in self.owned
+
+    async def workers(self) -> list[str]:
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(_workers_key, {self.worker_id: now})
+            pipe.zremrangebyscore(_workers_key, "-inf", now - self.lease_ttl)
+            pipe.zrange(_workers_key, 0, -1)
+            *_, workers = await pipe.execute()
+        return sorted(worker.decode() for worker in workers)
+
+    async def refresh(self) -> bool:
+        """Heartbeat, then take, renew or release leases to match our range.
+
+        Has to run more often than `lease_ttl`. Returns whether the owned
+        shards changed.
+        """
+        workers = await self.workers()
+        rank = workers.index(self.worker_id)
+        wanted = {
+            shard
+            for shard in range(self.shard_count)
+            if shard * len(workers) // self.shard_count == rank
+        }
+        ttl_ms = self.lease_ttl * 1000
+        for shard in self.owned - wanted:
+            await self.redis.eval(
+                _release_script, 1, _lease_key.format(shard), self.worker_id
+            )
+        owned = set()
+        for shard in wanted:
+            key = _lease_key.format(shard)
+            if shard in self.owned:
+                renewed = await self.redis.eval(
+                    _renew_script, 1, key, self.worker_id, ttl_ms
+                )
+                if renewed:
+                    owned.add(shard)
+                    continue
+            if await self.redis.set(key, self.worker_id, px=ttl_ms, nx=True):
+                owned.add(shard)
+        changed = owned != self.owned
+        if changed:
+            log.info(
+                f"{self.worker_id} owns {len(owned)}/{self.shard_count} shards "
+                f"({len(workers)} workers)"
+            )
+        self.owned = owned
+        return changed
+
+    async def leave(self) -> None:
+        for shard in self.owned:
+            await self.redis.eval(
+                _release_script, 1, _lease_key.format(shard), self.worker_id
+            )
+        await self.redis.zrem(_workers_key, self.worker_id)
+        self.owned = set()
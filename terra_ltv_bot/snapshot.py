@@ -0,0 +1,92 @@
+import json
+import logging
+import time
+from typing import Optional
+
+from aioredis import Redis
+
+from .index import SubscriptionIndex
+from .scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+_snapshot_key = "snapshot"
+_schedule_key = "snapshot:schedule"
+# an older snapshot is ignored, the bot starts cold
+SNAPSHOT_TTL = 10 * 60
+
+
+class Snapshot:
+    """Bot state saved to redis on shutdown for the next replica to start warm.
+
+    Holds the subscription index, the roles, and the scheduler next checks
+    and last ltvs. Every replica adds its own scheduled addresses to a shared
+    hash, so a sharded deployment keeps them all. Mutes and cached ltvs are
+    already in redis.
+    """
+
+    def __init__(
+        self, redis: Redis, index: SubscriptionIndex, scheduler: Scheduler
+    ) -> None:
+        self.redis = redis
+        self.index = index
+        self.scheduler = scheduler
+
+    async def save(self, roles: set[str]) -> None:
+        now = time.monotonic()
+        state = dict(at=time.time(), roles=sorted(roles), index=self.index.dump())
+        schedule = {
+            account_address: json.dumps(entry)
+            for account_address, entry in self.scheduler.dump(now).items()
+        }
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(_snapshot_key, json.dumps(state, default=str), ex=SNAPSHOT_TTL)
+            if schedule:
+                pipe.hset(_schedule_key, mapping=schedule)
+                pipe.expire(_schedule_key, SNAPSHOT_TTL)
+            await pipe.execute()
+        log.info(
+            f"saved snapshot of {len(self.index.by_address)} addresses, "
+            f"{len(schedule)} scheduled"
+        )
+
+    async def restore(self) -> Optional[set[str]]:
+        """Restore the index and scheduler, returns the roles if restored."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get(_snapshot_key)
+            pipe.hgetall(_schedule_key)
+            value, schedule = await pipe.execute()
+        if value is None:
+            return None
+        state = json.loads(value)
+        self.index.restore(state["index"])
+        elapsed = time.time() - state["at"]
+        self.scheduler.restore(
+            {
+                account_address.decode(): json.loads(entry)
+                for account_address, entry in schedule.items()
+            },
+            time.monotonic() - elapsed,
+        )
+        log.info(
+            f"restored snapshot of {len(self.index.by_address)} addresses, "
+            f"{len(self.scheduler)} scheduled, {elapsed:.0f}s old"
+        )
+        return set(state["roles"])
+
+    def prune(self) -> int:
+        """Untrack restored addresses missing from the loaded index.
+
+        The shared schedule may hold addresses unsubscribed since it was
+        saved, they are marked changed for the scan to drop the rest of their
+        state. Returns how many were untracked.
+        """
+        missing = [
+            a for a in self.scheduler.thresholds if a not in self.index.by_address
+        ]
+        for account_address in missing:
+            self.scheduler.untrack(account_address)
+        self.index.changed.update(missing)
+        if missing:
+            log.info(f"untracked {len(missing)} restored addresses")
+        return len(missing)
@@ -0,0 +1,186 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Optional, Union
+
+from aiogram.dispatcher.storage import BaseStorage
+from aioredis import Redis
+
+log = logging.getLogger(__name__)
+
+_fsm_key = "fsm:{}:{}:{}"
+_throttle_key = "throttle:{}:{}"
+
+# (tokens per second, burst) of each command, per user
+COMMAND_LIMITS = {
+    "subscribe": (1, 5),
+    "unsubscribe": (1, 5),
+    "list": (0.2, 3),
+    "ltv": (0.5, 5),
+    "history": (0.2, 3),
+    "users": (0.2, 3),
+}
+DEFAULT_LIMIT = (1, 5)
+
+# refill the bucket then take a token if there is one, returns 1 if taken
+_token_bucket_script = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call("hmget", KEYS[1], "tokens", "at")
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - at) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("hset", KEYS[1], "tokens", tostring(tokens), "at", tostring(now))
+redis.call("expire", KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+class Throttler:
+    """Token bucket limits per user and command shared by every replica."""
+
+    def __init__(self, redis: Redis) -> None:
+        self.redis = redis
+
+    async def allow(self, user_id: int, command: str) -> bool:
+        rate, burst = COMMAND_LIMITS.get(command, DEFAULT_LIMIT)
+        allowed = await self.redis.eval(
+            _token_bucket_script,
+            1,
+            _throttle_key.format(user_id, command),
+            rate,
+            burst,
+            time.time(),
+        )
+        if not allowed:
+            log.debug(f"{user_id} throttled on {command}")
+        return bool(allowed)
+
+
+class RedisStorage(BaseStorage):
+    """Aiogram storage on the bot's aioredis client.
+
+    Aiogram's own redis storages are written against the aioredis 1 api.
+    """
+
+    def __init__(self, redis: Redis, ttl: Optional[int] = None) -> None:
+        self.redis = redis
+        self.ttl = ttl
+
+    async def close(self) -> None:
+        pass
+
+    async def wait_closed(self) -> None:
+        pass
+
+    def _key(
+        self,
+        chat: Union[str, int, None],
+        user: Union[str, int, None],
+        kind: str,
+    ) -> str:
+        chat, user = self.check_address(chat=chat, user=user)
+        return _fsm_key.format(chat, user, kind)
+
+    async def _get_json(self, key: str, default: Any) -> Any:
+        value = await self.redis.get(key)
+        return json.loads(value) if value else default
+
+    async def _set_json(self, key: str, value: Any) -> None:
+        if value:
+            await self.redis.set(key, json.dumps(value), ex=self.ttl)
+        else:
+            await self.redis.delete(key)
+
+    async def get_state(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        default: Optional[str] = None,
+    ) -> Optional[str]:
+        state = await self.redis.get(self._key(chat, user, "state"))
+        return state.decode() if state else self.resolve_state(default)
+
+    async def set_state(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        state: Optional[Any] = None,
+    ) -> None:
+        key = self._key(chat, user, "state")
+        state = self.resolve_state(state)
+        if state is None:
+            await self.redis.delete(key)
+        else:
+            await self.redis.set(key, state, ex=self.ttl)
+
+    async def get_data(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        default: Optional[Dict] = None,
+    ) -> Dict:
+        return await self._get_json(self._key(chat, user, "data"), default or {})
+
+    async def set_data(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        data: Optional[Dict] = None,
+    ) -> None:
+        await self._set_json(self._key(chat, user, "data"), data)
+
+    async def update_data(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        data: Optional[Dict] = None,
+        **kwargs: Any,
+    ) -> None:
+        current = await self.get_data(chat=chat, user=user)
+        current.update(data or {}, **kwargs)
+        await self.set_data(chat=chat, user=user, data=current)
+
+    def has_bucket(self) -> bool:
+        return True
+
+    async def get_bucket(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        default: Optional[Dict] = None,
+    ) -> Dict:
+        return await self._get_json(self._key(chat, user, "bucket"), default or {})
+
+    async def set_bucket(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        bucket: Optional[Dict] = None,
+    ) -> None:
+        await self._set_json(self._key(chat, user, "bucket"), bucket)
+
+    async def update_bucket(
+        self,
+        *,
+        chat: Union[str, int, None] = None,
+        user: Union[str, int, None] = None,
+        bucket: Optional[Dict] = None,
+        **kwargs: Any,
+    ) -> None:
+        current = await self.get_bucket(chat=chat, user=user)
+        current.update(bucket or {}, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=current)
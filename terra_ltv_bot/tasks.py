@@ -1,19 +1,48 @@
 import asyncio
 import logging
+import time
 from datetime import timedelta
 from functools import wraps
-from typing import Callable
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
 
-from aiogram import Bot
 from aiogram.dispatcher import Dispatcher
-from aiogram.utils.exceptions import TelegramAPIError
 from aioredis import Redis
+from pymongo import UpdateMany
+from terra_sdk.exceptions import LCDResponseError
 
+from .cache import LtvCache
+from .changes import ChangeFilter
+from .events import BlockEvents
+from .history import History
+from .index import SubscriptionIndex
+from .metrics import ALERTS, SCAN_ADDRESSES, SCAN_CYCLE_SECONDS
 from .models import Address, Subscription
-from .terra import Terra
+from .outbox import Outbox
+from .scheduler import Scheduler
+from .sharding import Shards
+from .terra import Market, Terra, canonical_address
+from .triggers import TriggerIndex
+
+if TYPE_CHECKING:
+    from .positions import Positions
 
 log = logging.getLogger(__name__)
 
+# terra block time in seconds
+BLOCK_TIME = 6
+MUTE_TIME = timedelta(minutes=10)
+# seconds without any block event before scanning anyway
+EVENTS_FALLBACK = 2 * BLOCK_TIME
+# addresses per ltv_many call and concurrent calls of a scan tick
+SCAN_BATCH = 100
+SCAN_WORKERS = 8
+# seconds before following subscription changes again once the stream ended
+WATCH_RETRY = 5 * 60
+
+
+def mute_key(account_address: str, telegram_id: int) -> str:
+    return f"{account_address}:anchor:{telegram_id}"
+
 
 def every(frequency: int) -> Callable:
     def decorator(f: Callable) -> Callable:
@@ -30,9 +59,9 @@ def every(frequency: int) -> Callable:
 
 def skip_exceptions(f: Callable) -> Callable:
     @wraps(f)
-    async def wrapper(self) -> None:
+    async def wrapper(self, *args) -> None:
         try:
-            await f(self)
+            await f(self, *args)
         except Exception as e:
             log.error(f"exception in task: {e}", stack_info=True)
 
@@ -40,52 +69,329 @@ def skip_exceptions(f: Callable) -> Callable:
 
 
 class Tasks:
-    def __init__(self, dp: Dispatcher, bot: Bot, terra: Terra, redis: Redis) -> None:
-        self.bot = bot
+    def __init__(
+        self,
+        dp: Dispatcher,
+        terra: Terra,
+        redis: Redis,
+        outbox: Outbox,
+        ltv_cache: LtvCache,
+        index: SubscriptionIndex,
+        scheduler: Scheduler,
+        history: History,
+        shards: Optional[Shards] = None,
+        positions: Optional["Positions"] = None,
+        validator_address: Optional[str] = None,
+        ltv_epsilon: float = 0.0,
+        events: Optional[BlockEvents] = None,
+        index_reload: int = 5 * 60,
+    ) -> None:
         self.terra = terra
         self.redis = redis
+        self.outbox = outbox
+        self.ltv_cache = ltv_cache
+        self.index = index
+        self.scheduler = scheduler
+        self.history = history
+        self.shards = shards
+        self.positions = positions
+        self.triggers = TriggerIndex()
+        self.validator_address = validator_address
+        self.changes = ChangeFilter(ltv_epsilon)
+        self.events = events
+        self.index_reload = index_reload
+        dp._loop_create_task(self.outbox.run())
+        dp._loop_create_task(self.watch_subscriptions())
         dp._loop_create_task(self.check_ltv_ratio())
+        dp._loop_create_task(self.downsample_history())
+        if shards:
+            dp._loop_create_task(self.renew_shard_leases())
+        if validator_address:
+            dp._loop_create_task(self.sync_stakers())
+        if events:
+            dp._loop_create_task(events.run())
 
-    # @every(5 * 60)
-    @every(30)
+    @every(10)
     @skip_exceptions
+    async def renew_shard_leases(self) -> None:
+        if self.shards and await self.shards.refresh():
+            self.update_schedule(list(self.index.by_address))
+
+    async def watch_subscriptions(self) -> None:
+        """Follow the subscription changes made by other replicas.
+
+        They come from a change stream, which needs mongo to run as a replica
+        set. Without one, or once the stream ends, the whole index is
+        reloaded from mongo every `index_reload` seconds, or never if 0.
+        """
+        while True:
+            await self.follow_subscriptions()
+            await asyncio.sleep(self.index_reload or WATCH_RETRY)
+
+    @skip_exceptions
+    async def follow_subscriptions(self) -> None:
+        # only returns once the change stream is unavailable
+        await self.index.watch()
+        if self.index_reload:
+            log.info(
+                "reloading every subscription instead of following changes, "
+                f"again in {self.index_reload}s"
+            )
+            await self.index.load()
+        else:
+            log.warning(
+                "subscription changes of other replicas are not followed, "
+                f"following them again in {WATCH_RETRY}s"
+            )
+
+    @every(60 * 60)
+    @skip_exceptions
+    async def downsample_history(self) -> None:
+        count = await self.history.downsample(self.owns)
+        log.info(f"downsampled {count} ltv history buckets")
+
+    @every(60 * 60)
+    @skip_exceptions
+    async def sync_stakers(self) -> None:
+        """Flag the tracked addresses delegating to the validator.
+
+        Paged LCD queries list the delegators and one bulk write updates every
+        address flag.
+        """
+        if not self.validator_address:
+            return
+        delegators = await self.terra.delegators(self.validator_address)
+        stakers = [a for a in self.index.address_ids if a in delegators]
+        result = await Address.get_motor_collection().bulk_write(
+            [
+                UpdateMany(
+                    {"account_address": {"$in": stakers}, "is_staker": False},
+                    {"$set": {"is_staker": True}},
+                ),
+                UpdateMany(
+                    {"account_address": {"$nin": stakers}, "is_staker": True},
+                    {"$set": {"is_staker": False}},
+                ),
+            ],
+            ordered=False,
+        )
+        log.info(
+            f"{len(stakers)} stakers of {len(delegators)} delegators, "
+            f"{result.modified_count} addresses updated"
+        )
+
+    def owns(self, account_address: str) -> bool:
+        return self.shards is None or self.shards.owns(
+            self.index.address_id(account_address)
+        )
+
+    def update_schedule(self, account_addresses: Iterable[str]) -> None:
+        now = time.monotonic()
+        for account_address in account_addresses:
+            subscriptions = self.index.subscriptions(account_address)
+            if subscriptions and self.owns(account_address):
+                threshold = min(s.alert_threshold or 45 for s in subscriptions)
+                self.scheduler.track(account_address, threshold, now)
+                # evaluated again against the new subscriptions
+                self.changes.forget([account_address])
+            else:
+                self.scheduler.untrack(account_address)
+                self.triggers.remove(account_address)
+                self.changes.remove(account_address)
+                self.history.remove(account_address)
+                if self.positions:
+                    self.positions.remove([account_address])
+
     async def check_ltv_ratio(self) -> None:
-        log.debug("checking ltv ratios")
-        addresses: dict[str, Address] = {}
-        async for address in Address.find_all():
-            addresses[str(address.id)] = address
-        tasks = []
-        for address in addresses.values():
-            tasks.append(asyncio.create_task(self.terra.ltv(address.account_address)))
-        ltvs = await asyncio.gather(*tasks)
-        addresses_id_to_ltv = dict(
-            zip([address.id for address in addresses.values()], ltvs)
+        block = True
+        while True:
+            await self.scan_tick(block)
+            if self.events and self.events.connected:
+                # woken by the next block or anchor transaction, the timer is
+                # only a fallback
+                woken = await self.events.wait(EVENTS_FALLBACK)
+                block = not woken or self.events.new_block()
+            else:
+                await asyncio.sleep(BLOCK_TIME)
+                block = True
+
+    @skip_exceptions
+    async def scan_tick(self, block: bool = True) -> None:
+        with SCAN_CYCLE_SECONDS.time():
+            await self.scan(block)
+
+    async def scan(self, block: bool = True) -> None:
+        """Check the addresses transactions touched and, once per block, the
+        ones the scheduler hands out within its budget.
+
+        Transactions can wake the scan several times per block, only handing
+        out due addresses on blocks keeps the scan within `SCAN_BUDGET`.
+        """
+        self.update_schedule(self.index.drain_changes())
+        now = time.monotonic()
+        touched = await self.rescan(self.events.drain()) if self.events else []
+        if block:
+            self.scheduler.bump(touched, now)
+            due = self.scheduler.due(now)
+        else:
+            due = touched
+        if self.positions:
+            await self.price_tick(self.positions, due)
+        else:
+            await self.stream(due)
+        log.debug(
+            f"ltv calls: {self.terra.ltv_flight.hits} "
+            f"coalesced: {self.terra.ltv_flight.coalesced}"
+        )
+
+    async def rescan(self, account_addresses: set[str]) -> list[str]:
+        """Tracked addresses a transaction touched, their cached ltvs dropped."""
+        touched = [a for a in account_addresses if a in self.scheduler.thresholds]
+        if not touched:
+            return touched
+        # their cached ltv and position may predate the transaction
+        if self.positions:
+            self.positions.invalidate(touched)
+        else:
+            await self.ltv_cache.invalidate(touched)
+        log.debug(f"{len(touched)} addresses touched by transactions")
+        return touched
+
+    async def price_tick(self, positions: "Positions", due: list[str]) -> None:
+        """Check due addresses and the ones the new prices pushed over a trigger.
+
+        Due addresses get their positions queried again and their trigger
+        prices reindexed, other addresses are only checked when the oracle
+        prices crossed one of their triggers.
+        """
+        positions.invalidate(due)
+        if self.events is None or self.events.prices_moved():
+            await positions.update_prices()
+        prices = {token: float(price) for token, price in positions.prices.items()}
+        crossed = [
+            a for a in self.triggers.tick(prices) if a in self.scheduler.thresholds
+        ]
+        account_addresses = list(dict.fromkeys([*due, *crossed]))
+        ltvs = await positions.ltv_many(account_addresses, update_prices=False)
+        self.reschedule(account_addresses, ltvs)
+        for account_address in due:
+            if account_address in positions.rows:
+                loan, weights = positions.position(account_address)
+                thresholds = {
+                    s.telegram_id: s.alert_threshold or 45
+                    for s in self.index.subscriptions(account_address)
+                }
+                self.triggers.update(account_address, loan, weights, thresholds)
+        await self.evaluate(account_addresses, ltvs)
+
+    async def stream(self, account_addresses: list[str]) -> None:
+        """Check addresses in batches pulled by a bounded pool of workers.
+
+        Each batch is evaluated and alerted as soon as its ltvs arrive, so a
+        slow query only holds back its own batch. Batches are cut in contract
+        storage order so each pages its own range of borrowers, and share the
+        whitelist, prices and interest index fetched once per tick.
+        """
+        if not account_addresses:
+            return
+        account_addresses = sorted(account_addresses, key=canonical_address)
+        market: Optional[Market] = None
+        try:
+            market = await self.terra.market()
+        except LCDResponseError as e:
+            log.warning(f"Could not get market parameters, per batch instead: {e}")
+        batches = (
+            account_addresses[i : i + SCAN_BATCH]
+            for i in range(0, len(account_addresses), SCAN_BATCH)
         )
-        async for subscription in Subscription.find_all():
-            address_id = str(subscription.address_id)
-            account_address = addresses[address_id].account_address
-            ltv = addresses_id_to_ltv[subscription.address_id]
-            threshold = subscription.alert_threshold or 45
-            cache_key = f"{account_address}:anchor:{subscription.telegram_id}"
-            if threshold <= ltv and not await self.redis.get(cache_key):
+
+        async def worker() -> None:
+            for batch in batches:
                 try:
-                    await self.bot.send_message(
-                        subscription.telegram_id,
-                        (
-                            f"🚨 Anchor LTV ratio is over {threshold}% ({ltv}%):\n"
-                            f"<pre>{account_address}</pre>"
-                        ),
-                    )
-                    log.info(
-                        f"{account_address} {subscription.telegram_id} {ltv} alerted"
+                    ltvs = await self.ltv_cache.ltv_many(
+                        batch, bulk=True, market=market
                     )
-                    await self.redis.set(cache_key, 1, ex=timedelta(minutes=10))
-                except TelegramAPIError as e:
-                    log.warning(
-                        f"Couldn't send alert to {subscription.telegram_id} "
-                        f"for {account_address}: {e}"
-                    )
-            elif threshold <= ltv:
-                log.debug(f"{account_address} {subscription.telegram_id} {ltv} muted")
+                    self.reschedule(batch, ltvs)
+                    await self.evaluate(batch, ltvs)
+                except Exception as e:
+                    log.error(f"exception checking batch: {e}", stack_info=True)
+
+        await asyncio.gather(*[worker() for _ in range(SCAN_WORKERS)])
+
+    def reschedule(self, account_addresses: list[str], ltvs: dict[str, float]) -> None:
+        """Schedule addresses from their new ltv, the ones whose ltv could not
+        be queried are checked again on the next block."""
+        now = time.monotonic()
+        failed = []
+        for account_address in account_addresses:
+            ltv = ltvs.get(account_address)
+            if ltv is None:
+                failed.append(account_address)
             else:
-                log.debug(f"{account_address} {ltv} ok")
+                self.scheduler.schedule(account_address, ltv, now)
+        if failed:
+            log.info(f"{len(failed)} ltvs could not be queried, retrying")
+            self.scheduler.retry(failed, now)
+
+    async def evaluate(
+        self, account_addresses: list[str], ltvs: dict[str, float]
+    ) -> None:
+        # a failed lookup is no sample, it must not alert nor be recorded
+        account_addresses = [a for a in account_addresses if a in ltvs]
+        if not account_addresses:
+            return
+        log.debug(f"checked {len(account_addresses)} ltv ratios")
+        SCAN_ADDRESSES.inc(len(account_addresses))
+        changed = set(self.changes.changed({a: ltvs[a] for a in account_addresses}))
+        alerts = []
+        for account_address in account_addresses:
+            ltv = ltvs[account_address]
+            # unchanged addresses under every threshold cannot alert, the ones
+            # over one are evaluated again to alert once their mute expires
+            threshold = self.scheduler.thresholds.get(account_address, 0)
+            if account_address not in changed and ltv < threshold:
+                continue
+            for subscription in self.index.subscriptions(account_address):
+                if (subscription.alert_threshold or 45) <= ltv:
+                    alerts.append((subscription, account_address, ltv))
+                else:
+                    log.debug(f"{account_address} {ltv} ok")
+        await self.send_alerts(alerts)
+        await self.history.record({a: ltvs[a] for a in account_addresses})
+
+    async def send_alerts(self, alerts: list[tuple[Subscription, str, float]]) -> None:
+        """Queue alerts for the subscriptions over their threshold unless muted.
+
+        Mute keys are read with a single MGET, then the alerts are queued to
+        the outbox and their mute keys written in a single pipeline.
+        """
+        if not alerts:
+            return
+        cache_keys = [
+            mute_key(account_address, subscription.telegram_id)
+            for subscription, account_address, _ in alerts
+        ]
+        muted = await self.redis.mget(cache_keys)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for (subscription, account_address, ltv), cache_key, is_muted in zip(
+                alerts, cache_keys, muted
+            ):
+                if is_muted:
+                    log.debug(
+                        f"{account_address} {subscription.telegram_id} {ltv} muted"
+                    )
+                    ALERTS.inc(status="muted")
+                    continue
+                threshold = subscription.alert_threshold or 45
+                self.outbox.push(
+                    pipe,
+                    subscription.telegram_id,
+                    (
+                        f"🚨 Anchor LTV ratio is over {threshold}% ({ltv}%):\n"
+                        f"<pre>{account_address}</pre>"
+                    ),
+                )
+                pipe.set(cache_key, 1, ex=MUTE_TIME)
+                log.info(f"{account_address} {subscription.telegram_id} {ltv} alerted")
+                ALERTS.inc(status="queued")
+            await pipe.execute()
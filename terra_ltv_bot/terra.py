@@ -1,14 +1,51 @@
 import asyncio
 import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from decimal import Decimal
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterable,
+    Iterator,
+    Optional,
+    TypeVar,
+)
 
-from aiolimiter import AsyncLimiter
-from terra_sdk.client.lcd.lcdclient import AsyncLCDClient
+from bech32 import bech32_decode, bech32_encode, convertbits
 from terra_sdk.exceptions import LCDResponseError
 
+from .lcd import LCDPool, LCDUnavailable
+from .limiter import BACKGROUND, INTERACTIVE, PriorityLimiter
+from .metrics import (
+    LCD_ERRORS,
+    LCD_QUERY_SECONDS,
+    LIMITER_QUEUE_DEPTH,
+    LIMITER_WAIT_SECONDS,
+    LTV_COALESCED,
+)
+
 FINDER_URL = "https://finder.terra.money/"
+# anchor contracts cap paginated queries at 30 elements
+PAGE_LIMIT = 30
+DELEGATIONS_PAGE_LIMIT = 1000
+# addresses an ltv_many call queries one by one when pages fail or miss them
+FALLBACK_LIMIT = PAGE_LIMIT
+# share of the LCD budget only interactive queries can use
+INTERACTIVE_SHARE = 0.2
+
+# limiter tier of the queries made in the current context
+_tier: ContextVar[str] = ContextVar("tier", default=BACKGROUND)
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+# market global interest index, max ltvs and prices by collateral token
+Market = tuple[Decimal, dict[str, Decimal], dict[str, Decimal]]
+
 
 def is_account_address(account_address: str) -> bool:
     if account_address.startswith("terra1") and len(account_address) == 44:
@@ -17,47 +54,409 @@ def is_account_address(account_address: str) -> bool:
         return False
 
 
+def canonical_address(account_address: str) -> bytes:
+    _, data = bech32_decode(account_address)
+    canonical = convertbits(data, 5, 8, False) if data else None
+    if canonical is None:
+        raise ValueError(f"invalid account address {account_address}")
+    return bytes(canonical)
+
+
+def preceding_address(account_address: str) -> Optional[str]:
+    """Address right before `account_address` in contract storage order.
+
+    Anchor paginates on canonical bytes with an exclusive `start_after`, so
+    this is what to pass to get a page starting at `account_address`.
+    """
+    canonical = canonical_address(account_address)
+    value = int.from_bytes(canonical, "big")
+    if value == 0:
+        return None
+    previous = (value - 1).to_bytes(len(canonical), "big")
+    words = convertbits(previous, 8, 5)
+    return bech32_encode("terra", words) if words else None
+
+
+def accrued_loan(info: dict, global_interest_index: Decimal) -> int:
+    """Loan of a `borrower_infos` element with its interest accrued.
+
+    Listed loans are as of the borrower's last market interaction, the market
+    accrues them by the growth of the global interest index since then.
+    """
+    loan = Decimal(info["loan_amount"])
+    if loan == 0:
+        return 0
+    return int(loan * global_interest_index / Decimal(info["interest_index"]))
+
+
+def ltv_ratio(borrowed: int, limit: int) -> float:
+    if limit > 0:
+        return round(((borrowed * 60) / limit), 2)
+    return 0
+
+
+class SingleFlight:
+    """Shares a single in-flight call between concurrent callers of a key.
+
+    `hits` counts every call and `coalesced` the ones that joined a call
+    already in flight instead of starting their own.
+    """
+
+    def __init__(self) -> None:
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, f: Callable[[], Awaitable[T]]) -> T:
+        self.hits += 1
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(f())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+            LTV_COALESCED.inc()
+        # a cancelled caller must not cancel the call for the others
+        return await asyncio.shield(future)
+
+
 class Terra:
     def __init__(
         self,
-        lcd: AsyncLCDClient,
+        pool: LCDPool,
         anchor_market_contract: str,
         anchor_overseer_contract: str,
+        raw_queries: bool = False,
     ) -> None:
-        self.lcd = lcd
-        self.rate_limiter = AsyncLimiter(200, 10)
+        self.pool = pool
+        self.raw_queries = raw_queries
+        # endpoints adapt their own rate, this only caps the total
+        burst = 200 * len(pool)
+        self.rate_limiter = PriorityLimiter(
+            rate=burst / 10, burst=burst, reserve=burst * INTERACTIVE_SHARE
+        )
         self.anchor_market_contact = anchor_market_contract
         self.anchor_overseer_contact = anchor_overseer_contract
+        self.anchor_oracle_contract: Optional[str] = None
+        self.ltv_flight = SingleFlight()
+
+    @contextmanager
+    def interactive(self) -> Iterator[None]:
+        """Queries made within, and in tasks started within, jump the queue."""
+        token = _tier.set(INTERACTIVE)
+        try:
+            yield
+        finally:
+            _tier.reset(token)
 
-    async def ltv(self, account_address: str) -> float:
-        async with self.rate_limiter:
+    @asynccontextmanager
+    async def limited(self) -> AsyncIterator[None]:
+        tier = _tier.get()
+        start = time.perf_counter()
+        LIMITER_QUEUE_DEPTH.set(self.rate_limiter.depth(tier) + 1, tier=tier)
+        try:
+            await self.rate_limiter.acquire(tier)
+        finally:
+            LIMITER_QUEUE_DEPTH.set(self.rate_limiter.depth(tier), tier=tier)
+        LIMITER_WAIT_SECONDS.observe(time.perf_counter() - start, tier=tier)
+        yield
+
+    async def contract_query(self, contract_address: str, query: dict) -> dict:
+        query_name = next(iter(query))
+        try:
+            with LCD_QUERY_SECONDS.time(query=query_name):
+                if self.raw_queries:
+                    return await self.pool.request(
+                        lambda raw: raw.contract_query(contract_address, query),
+                        raw=True,
+                        tier=_tier.get(),
+                    )
+                return await self.pool.request(
+                    lambda lcd: lcd.wasm.contract_query(
+                        contract_address=contract_address, query=query
+                    ),
+                    tier=_tier.get(),
+                )
+        except LCDResponseError:
+            LCD_ERRORS.inc(query=query_name)
+            raise
+
+    async def height(self) -> int:
+        """Latest block height."""
+        async with self.limited():
+            try:
+                with LCD_QUERY_SECONDS.time(query="block_info"):
+                    block_info = await self.pool.request(
+                        lambda lcd: lcd.tendermint.block_info(), tier=_tier.get()
+                    )
+            except LCDResponseError:
+                LCD_ERRORS.inc(query="block_info")
+                raise
+        return int(block_info["block"]["header"]["height"])
+
+    async def ltv(self, account_address: str) -> Optional[float]:
+        """Ltv of an address, None if it could not be queried."""
+        # a command joining a scan's call would wait in the background tier
+        return await self.ltv_flight.do(
+            (_tier.get(), account_address), lambda: self._ltv(account_address)
+        )
+
+    async def _ltv(self, account_address: str) -> Optional[float]:
+        async with self.limited():
             try:
                 borrower_info, borrow_limit = await asyncio.gather(
-                    self.lcd.wasm.contract_query(
+                    self.contract_query(
                         contract_address=self.anchor_market_contact,
                         query=dict(borrower_info=dict(borrower=account_address)),
                     ),
-                    self.lcd.wasm.contract_query(
+                    self.contract_query(
                         contract_address=self.anchor_overseer_contact,
                         query=dict(borrow_limit=dict(borrower=account_address)),
                     ),
                 )
                 borrowed = int(borrower_info["loan_amount"])
                 limit = int(borrow_limit["borrow_limit"])
-                if limit > 0:
-                    return round(((borrowed * 60) / limit), 2)
+                return ltv_ratio(borrowed, limit)
             except LCDResponseError as e:
                 log.warning(f"Could not get ltv for {account_address}: {e}")
-            return 0
+            return None
+
+    async def ltv_many(
+        self, account_addresses: Iterable[str], market: Optional[Market] = None
+    ) -> dict[str, float]:
+        """Ltv of many addresses using paginated anchor queries.
 
-    async def is_staking(self, account_address: str, validator_address: str) -> bool:
+        Loans come from the market `borrower_infos` pages, accrued with the
+        market global interest index like `borrower_info` does, and borrow
+        limits are computed from the overseer `all_collaterals` pages, its
+        whitelist and the oracle prices, the same way the overseer computes
+        `borrow_limit`. Addresses without a loan get an ltv of 0, the ones
+        that could not be queried are left out. Callers checking many batches
+        at once can pass the `market` they share.
+        """
+        addresses = sorted(set(account_addresses), key=canonical_address)
+        ltvs: dict[str, float] = {}
+        if not addresses:
+            return ltvs
         try:
-            delegations = await self.lcd.staking.delegations(
-                account_address, validator_address
-            )
-            if delegations and delegations[0].balance.amount > 0:
-                return True
+            if market is None:
+                (infos, failed), fetched = await asyncio.gather(
+                    self.paginate(
+                        self.anchor_market_contact, "borrower_infos", addresses
+                    ),
+                    self.market(),
+                )
+                market = fetched
             else:
-                return False
-        except LCDResponseError:
-            return False
+                infos, failed = await self.paginate(
+                    self.anchor_market_contact, "borrower_infos", addresses
+                )
+        except LCDUnavailable as e:
+            log.warning(f"Could not page borrower infos: {e}")
+            return ltvs
+        except LCDResponseError as e:
+            log.warning(f"Could not get market parameters: {e}")
+            return await self._ltv_each(addresses)
+        global_interest_index, max_ltvs, prices = market
+        loans: dict[str, int] = {}
+        borrowers = []
+        unlisted = set(failed)
+        for account_address in addresses:
+            if account_address in unlisted:
+                continue
+            info = infos.get(account_address)
+            loan = accrued_loan(info, global_interest_index) if info else 0
+            if loan == 0:
+                ltvs[account_address] = 0
+            else:
+                loans[account_address] = loan
+                borrowers.append(account_address)
+        if borrowers:
+            try:
+                collaterals, failed_collaterals = await self.paginate(
+                    self.anchor_overseer_contact, "all_collaterals", borrowers
+                )
+            except LCDUnavailable as e:
+                log.warning(f"Could not page collaterals: {e}")
+                return ltvs
+            failed += failed_collaterals
+            for account_address in borrowers:
+                collateral = collaterals.get(account_address)
+                if collateral is None:
+                    if account_address not in failed_collaterals:
+                        log.debug(f"{account_address} missed by pages")
+                        failed.append(account_address)
+                    continue
+                limit = sum(
+                    Decimal(amount) * prices.get(token, 0) * max_ltvs.get(token, 0)
+                    for token, amount in collateral["collaterals"]
+                )
+                ltvs[account_address] = ltv_ratio(loans[account_address], int(limit))
+        if failed:
+            ltvs.update(await self._ltv_each(failed))
+        return ltvs
+
+    async def positions(
+        self, account_addresses: Iterable[str]
+    ) -> dict[str, tuple[float, list[tuple[str, int]]]]:
+        """Loan and collaterals of many addresses from the paginated listings.
+
+        Loans are per unit of the market global interest index, multiplying
+        them by the current index gives the loan with its accrued interest.
+        Addresses in pages that failed are left out.
+        """
+        addresses = sorted(set(account_addresses), key=canonical_address)
+        if not addresses:
+            return {}
+        (infos, failed), (collaterals, failed_collaterals) = await asyncio.gather(
+            self.paginate(self.anchor_market_contact, "borrower_infos", addresses),
+            self.paginate(self.anchor_overseer_contact, "all_collaterals", addresses),
+        )
+        unlisted = {*failed, *failed_collaterals}
+        positions: dict[str, tuple[float, list[tuple[str, int]]]] = {}
+        for account_address in addresses:
+            if account_address in unlisted:
+                continue
+            info = infos.get(account_address)
+            collateral = collaterals.get(account_address)
+            positions[account_address] = (
+                accrued_loan(info, Decimal(1)) if info else 0,
+                [
+                    (token, int(amount))
+                    for token, amount in (collateral or {}).get("collaterals", [])
+                ],
+            )
+        return positions
+
+    async def _ltv_each(self, account_addresses: Iterable[str]) -> dict[str, float]:
+        """Ltvs queried one address at a time, for the ones pages missed.
+
+        At most `FALLBACK_LIMIT` addresses are queried, the others are left
+        out rather than piling single queries on a failing LCD.
+        """
+        account_addresses = list(account_addresses)
+        if len(account_addresses) > FALLBACK_LIMIT:
+            log.warning(
+                f"{len(account_addresses) - FALLBACK_LIMIT} addresses left out "
+                "of the per address fallback"
+            )
+            account_addresses = account_addresses[:FALLBACK_LIMIT]
+        ltvs = await asyncio.gather(*[self.ltv(a) for a in account_addresses])
+        return {a: ltv for a, ltv in zip(account_addresses, ltvs) if ltv is not None}
+
+    async def paginate(
+        self, contract_address: str, query_name: str, account_addresses: list[str]
+    ) -> tuple[dict[str, dict], list[str]]:
+        """Page through a borrowers listing, only fetching pages holding
+        one of `account_addresses` (sorted in canonical order).
+
+        Each page resolves every address up to its last borrower, so the
+        number of queries is bounded by both the number of addresses and
+        the number of pages they span. Returns the listed elements by
+        borrower, and the addresses of failed pages: a page that fails only
+        fails the address it started at, paging resumes at the next one.
+        `LCDUnavailable` is raised as is.
+        """
+        found: dict[str, dict] = {}
+        failed: list[str] = []
+        index = 0
+        while index < len(account_addresses):
+            query: dict = dict(limit=PAGE_LIMIT)
+            start_after = preceding_address(account_addresses[index])
+            if start_after:
+                query["start_after"] = start_after
+            try:
+                async with self.limited():
+                    result = await self.contract_query(
+                        contract_address=contract_address,
+                        query={query_name: query},
+                    )
+            except LCDUnavailable:
+                raise
+            except LCDResponseError as e:
+                log.warning(f"Could not get {query_name} page: {e}")
+                failed.append(account_addresses[index])
+                index += 1
+                continue
+            page = result[query_name]
+            for element in page:
+                found[element["borrower"]] = element
+            if len(page) < PAGE_LIMIT:
+                break
+            last = canonical_address(page[-1]["borrower"])
+            while (
+                index < len(account_addresses)
+                and canonical_address(account_addresses[index]) <= last
+            ):
+                index += 1
+        return found, failed
+
+    async def market(self) -> Market:
+        global_interest_index, max_ltvs, prices = await asyncio.gather(
+            self.global_interest_index(), self.max_ltvs(), self.collateral_prices()
+        )
+        return global_interest_index, max_ltvs, prices
+
+    async def global_interest_index(self) -> Decimal:
+        async with self.limited():
+            state = await self.contract_query(
+                contract_address=self.anchor_market_contact,
+                query=dict(state=dict()),
+            )
+        return Decimal(state["global_interest_index"])
+
+    async def max_ltvs(self) -> dict[str, Decimal]:
+        async with self.limited():
+            whitelist = await self.contract_query(
+                contract_address=self.anchor_overseer_contact,
+                query=dict(whitelist=dict(limit=PAGE_LIMIT)),
+            )
+        return {
+            elem["collateral_token"]: Decimal(elem["max_ltv"])
+            for elem in whitelist["elems"]
+        }
+
+    async def oracle_contract(self) -> str:
+        if self.anchor_oracle_contract is None:
+            async with self.limited():
+                config = await self.contract_query(
+                    contract_address=self.anchor_overseer_contact,
+                    query=dict(config=dict()),
+                )
+            self.anchor_oracle_contract = config["oracle_contract"]
+        return self.anchor_oracle_contract
+
+    async def collateral_prices(self) -> dict[str, Decimal]:
+        oracle_contract = await self.oracle_contract()
+        async with self.limited():
+            prices = await self.contract_query(
+                contract_address=oracle_contract,
+                query=dict(prices=dict(limit=PAGE_LIMIT)),
+            )
+        return {
+            price["asset"]: Decimal(price["price"]) for price in prices["prices"]
+        }
+
+    async def delegators(self, validator_address: str) -> set[str]:
+        """Addresses with a non zero delegation to a validator.
+
+        Delegations are paged, a large validator's would not fit in one
+        response within the LCD timeout.
+        """
+        path = f"/cosmos/staking/v1beta1/validators/{validator_address}/delegations"
+        params = {"pagination.limit": str(DELEGATIONS_PAGE_LIMIT)}
+        delegators: set[str] = set()
+        while True:
+            async with self.limited():
+                # the sdk staking api only has the unpaged legacy endpoint
+                page = await self.pool.request(
+                    lambda lcd: lcd._get(path, params, raw=True), tier=_tier.get()
+                )
+            for response in page["delegation_responses"]:
+                if int(response["balance"]["amount"]) > 0:
+                    delegators.add(response["delegation"]["delegator_address"])
+            next_key = (page.get("pagination") or {}).get("next_key")
+            if not next_key:
+                return delegators
+            params = {**params, "pagination.key": next_key}
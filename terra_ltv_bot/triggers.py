@@ -0,0 +1,80 @@
+import bisect
+import logging
+
+log = logging.getLogger(__name__)
+
+Trigger = tuple[float, str, int]
+
+
+class TriggerIndex:
+    """Collateral prices at which subscriptions cross their threshold.
+
+    A borrower with a single collateral crosses `threshold` once its price
+    falls to `loan * 60 / (threshold * amount * max_ltv)`. These trigger
+    prices are kept sorted per collateral token, so a price fall only touches
+    the subscriptions whose trigger lies between the old and new prices.
+    With several collaterals the trigger of one depends on the prices of the
+    others, those borrowers are returned on every tick instead.
+    """
+
+    def __init__(self) -> None:
+        self.triggers: dict[str, list[Trigger]] = {}
+        self.entries: dict[str, list[tuple[str, Trigger]]] = {}
+        self.dense: set[str] = set()
+        self.prices: dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return sum(len(triggers) for triggers in self.triggers.values())
+
+    def update(
+        self,
+        account_address: str,
+        loan: float,
+        weights: dict[str, float],
+        thresholds: dict[int, float],
+    ) -> None:
+        """Index the triggers of an address.
+
+        `weights` are the collateral amounts times their max ltv by token and
+        `thresholds` the alert thresholds by telegram id.
+        """
+        self.remove(account_address)
+        tokens = [token for token, weight in weights.items() if weight > 0]
+        if not loan or not tokens:
+            return
+        if len(tokens) > 1:
+            self.dense.add(account_address)
+            return
+        token = tokens[0]
+        entries = self.entries[account_address] = []
+        triggers = self.triggers.setdefault(token, [])
+        for telegram_id, threshold in thresholds.items():
+            price = loan * 60 / (threshold * weights[token])
+            trigger = (price, account_address, telegram_id)
+            bisect.insort(triggers, trigger)
+            entries.append((token, trigger))
+
+    def remove(self, account_address: str) -> None:
+        self.dense.discard(account_address)
+        for token, trigger in self.entries.pop(account_address, []):
+            triggers = self.triggers[token]
+            del triggers[bisect.bisect_left(triggers, trigger)]
+
+    def crossed(self, token: str, old: float, new: float) -> set[str]:
+        """Addresses with a trigger in [new, old), crossed by a fall to new."""
+        if new >= old:
+            return set()
+        triggers = self.triggers.get(token, [])
+        start = bisect.bisect_left(triggers, (new,))
+        end = bisect.bisect_left(triggers, (old,))
+        return {account_address for _, account_address, _ in triggers[start:end]}
+
+    def tick(self, prices: dict[str, float]) -> set[str]:
+        """Addresses to evaluate now that the prices moved to `prices`."""
+        touched = set(self.dense)
+        for token, price in prices.items():
+            old = self.prices.get(token)
+            if old is not None:
+                touched |= self.crossed(token, old, price)
+        self.prices.update(prices)
+        return touched
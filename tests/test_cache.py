@@ -0,0 +1,79 @@
+import asyncio
+from typing import Optional
+
+from terra_ltv_bot.cache import LtvCache
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.values: dict[str, bytes] = {}
+        self.index: dict[str, int] = {}
+
+    async def mget(self, keys: list[str]) -> list[Optional[bytes]]:
+        return [self.values.get(key) for key in keys]
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.results: list = []
+
+    async def __aenter__(self) -> "FakePipeline":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        pass
+
+    def set(self, key: str, value: str, ex=None) -> None:
+        self.redis.values[key] = value.encode()
+        self.results.append(True)
+
+    def zadd(self, key: str, mapping: dict[str, int]) -> None:
+        self.redis.index.update(mapping)
+        self.results.append(len(mapping))
+
+    def zcard(self, key: str) -> None:
+        self.results.append(len(self.redis.index))
+
+    async def execute(self) -> list:
+        return self.results
+
+
+class FakeTerra:
+    def __init__(self, ltvs: dict[str, Optional[float]]) -> None:
+        self.ltvs = ltvs
+        self.queried: list[str] = []
+
+    async def height(self) -> int:
+        return 10
+
+    async def ltv(self, account_address: str) -> Optional[float]:
+        self.queried.append(account_address)
+        return self.ltvs[account_address]
+
+    async def ltv_many(self, account_addresses, market=None) -> dict[str, float]:
+        self.queried.extend(account_addresses)
+        return {
+            a: ltv
+            for a in account_addresses
+            for ltv in [self.ltvs[a]]
+            if ltv is not None
+        }
+
+
+def test_failed_lookups_are_not_cached():
+    async def run(bulk: bool) -> None:
+        terra = FakeTerra({"ok": 12.5, "failed": None})
+        cache = LtvCache(terra, FakeRedis(), ttl=60, max_size=10)  # type: ignore
+        assert await cache.ltv_many(["ok", "failed"], bulk=bulk) == {"ok": 12.5}
+        assert await cache.ltv("failed") is None
+        assert await cache.ltv("ok") == 12.5
+        # the failed address is queried again, the other one is cached
+        assert terra.queried.count("failed") == 2
+        assert terra.queried.count("ok") == 1
+
+    asyncio.run(run(bulk=False))
+    asyncio.run(run(bulk=True))
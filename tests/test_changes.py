@@ -0,0 +1,19 @@
+from terra_ltv_bot.changes import ChangeFilter
+
+
+def test_only_moves_over_epsilon_are_changes():
+    changes = ChangeFilter(epsilon=0.5)
+    assert changes.changed({"a": 10, "b": 20}) == ["a", "b"]
+    assert changes.changed({"a": 10.3, "b": 21}) == ["b"]
+    # small moves add up
+    assert changes.changed({"a": 10.6, "b": 21}) == ["a"]
+
+
+def test_forgotten_and_removed_addresses_are_changes():
+    changes = ChangeFilter(epsilon=0.5)
+    changes.changed({"a": 10, "b": 20})
+    changes.forget(["a"])
+    changes.remove("b")
+    assert changes.changed({"a": 10, "b": 20, "c": 30}) == ["a", "b", "c"]
+    # b reused its freed slot, only c needed a new one
+    assert len(changes.ltvs) == 3
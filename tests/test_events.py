@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+
+from terra_ltv_bot import events
+from terra_ltv_bot.events import BlockEvents
+
+CONTRACT_TX = "tm.event='Tx' AND wasm.contract_address='market'"
+
+
+class Stop(BaseException):
+    pass
+
+
+def test_a_malformed_message_does_not_stop_the_listener(monkeypatch):
+    monkeypatch.setattr(events, "RECONNECT_MIN", 0)
+    follows = []
+
+    async def run() -> None:
+        terra = SimpleNamespace(anchor_oracle_contract="oracle")
+        block_events = BlockEvents("ws://tendermint", terra)  # type: ignore
+
+        async def follow() -> None:
+            follows.append(block_events)
+            if len(follows) == 1:
+                # events keyed by attribute, not a list
+                message = dict(result=dict(query=CONTRACT_TX, events=["x"]))
+                block_events.handle(message)
+            raise Stop()
+
+        block_events.follow = follow  # type: ignore
+        await block_events.run()
+
+    try:
+        asyncio.run(run())
+    except Stop:
+        pass
+    assert len(follows) == 2
@@ -0,0 +1,43 @@
+import asyncio
+from types import SimpleNamespace
+
+from terra_ltv_bot.handlers import Handlers, parse_subscriptions
+
+A = "terra1" + "a" * 38
+B = "terra1" + "b" * 38
+C = "terra1" + "c" * 38
+
+
+def test_mixed_separators():
+    text = f"{A} 55, {B};50\n{C},60\r\n"
+    assert parse_subscriptions(text) == [(A, "55"), (B, "50"), (C, "60")]
+
+
+def test_missing_thresholds():
+    assert parse_subscriptions(f"{A} {B} 50 {C}") == [(A, None), (B, "50"), (C, None)]
+    assert parse_subscriptions("  ") == []
+
+
+def test_invalid_tokens_are_kept_for_validation():
+    # a token after a threshold is an address, after an address a threshold
+    assert parse_subscriptions(f"{A} high 50 {B} 10 20") == [
+        (A, "high"),
+        ("50", None),
+        (B, "10"),
+        ("20", None),
+    ]
+
+
+def test_rejected_tokens_are_escaped():
+    replies = []
+
+    async def reply(text: str) -> None:
+        replies.append(text)
+
+    message = SimpleNamespace(
+        from_user=SimpleNamespace(id=1, username="user"), reply=reply
+    )
+    handlers = Handlers.__new__(Handlers)
+    asyncio.run(handlers.subscribe_many(message, [("<b>", None), (A, "<i>")]))
+    assert "&lt;b&gt;: invalid address" in replies[0]
+    assert "<b>" not in replies[0] and "<i>" not in replies[0]
@@ -0,0 +1,23 @@
+import asyncio
+
+from terra_ltv_bot.history import SAMPLE_INTERVAL, History
+
+
+class FakeCollection:
+    writes: list = []
+
+    @classmethod
+    async def bulk_write(cls, requests: list, ordered: bool = True) -> None:
+        cls.writes.append(requests)
+
+
+def test_removed_addresses_are_forgotten() -> None:
+    history = History(retention=0)
+    history._collection = lambda: FakeCollection  # type: ignore
+    asyncio.run(history.record({"a": 10.0, "b": 20.0}, now=1000))
+    history.remove("a")
+    assert set(history.last_sample) == {"b"}
+    # sampled again as soon as it is scanned again
+    asyncio.run(history.record({"a": 10.0, "b": 20.0}, now=1000 + SAMPLE_INTERVAL / 2))
+    assert set(history.last_sample) == {"a", "b"}
+    assert [len(requests) for requests in FakeCollection.writes] == [2, 1]
@@ -0,0 +1,41 @@
+import asyncio
+
+from beanie.odm.fields import PydanticObjectId
+
+from terra_ltv_bot.index import SubscriptionIndex
+from terra_ltv_bot.models import Address, Subscription
+
+ACCOUNT_ADDRESS = "terra1" + "q" * 38
+
+
+def test_changes_made_while_loading_are_kept(monkeypatch):
+    address = Address.construct(id=PydanticObjectId(), account_address=ACCOUNT_ADDRESS)
+    stored = [
+        Subscription.construct(
+            id=PydanticObjectId(),
+            address_id=address.id,
+            protocol="anchor",
+            alert_threshold=None,
+            telegram_id=telegram_id,
+            telegram_name=str(telegram_id),
+        )
+        for telegram_id in (1, 2)
+    ]
+    index = SubscriptionIndex()
+    for subscription in stored:
+        index.add(ACCOUNT_ADDRESS, subscription)
+
+    async def addresses():
+        yield address
+
+    async def subscriptions():
+        # user 1 unsubscribes after mongo was read, while the index loads
+        yield stored[0]
+        index.remove(ACCOUNT_ADDRESS, 1)
+        yield stored[1]
+
+    monkeypatch.setattr(Address, "find_all", addresses)
+    monkeypatch.setattr(Subscription, "find_all", subscriptions)
+    asyncio.run(index.load())
+    assert [s.telegram_id for s in index.subscriptions(ACCOUNT_ADDRESS)] == [2]
+    assert index.addresses(1) == {}
@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+from terra_sdk.exceptions import LCDResponseError
+
+from terra_ltv_bot.lcd import LCDPool, LCDUnavailable
+from terra_ltv_bot.limiter import BACKGROUND, INTERACTIVE
+
+
+class Response:
+    def __init__(self, status: int) -> None:
+        self.status = status
+
+
+def failing(statuses: dict[str, int]):
+    async def f(lcd) -> str:
+        status = statuses.get(lcd.url)
+        if status:
+            raise LCDResponseError(message="", response=Response(status))
+        return lcd.url
+
+    return f
+
+
+def test_gateway_errors_fail_over_to_the_next_endpoint():
+    pool = LCDPool(["http://a", "http://b"], "test")
+    result = asyncio.run(pool.request(failing({"http://a": 503}), raw=True))
+    assert result == "http://b"
+    assert [endpoint.failures for endpoint in pool.endpoints] == [1, 0]
+
+
+def test_unavailable_once_every_endpoint_failed():
+    pool = LCDPool(["http://a", "http://b"], "test")
+    with pytest.raises(LCDUnavailable):
+        asyncio.run(
+            pool.request(failing({"http://a": 502, "http://b": 429}), raw=True)
+        )
+
+
+def test_query_errors_are_raised_as_is():
+    pool = LCDPool(["http://a", "http://b"], "test")
+    with pytest.raises(LCDResponseError) as e:
+        asyncio.run(pool.request(failing({"http://a": 400}), raw=True))
+    assert e.value.response.status == 400
+    assert all(endpoint.failures == 0 for endpoint in pool.endpoints)
+
+
+def test_interactive_requests_overtake_a_background_backlog():
+    async def run() -> None:
+        pool = LCDPool(["http://a"], "test")
+        pool.endpoints[0].rate = 100
+        order = []
+
+        async def request(tier: str) -> None:
+            async def f(lcd) -> None:
+                order.append(tier)
+
+            await pool.request(f, raw=True, tier=tier)
+
+        background = [asyncio.ensure_future(request(BACKGROUND)) for _ in range(50)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(request(INTERACTIVE), 0.1)
+        assert order.count(BACKGROUND) < 10
+        await asyncio.gather(*background)
+
+    asyncio.run(run())
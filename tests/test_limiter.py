@@ -0,0 +1,39 @@
+import asyncio
+
+from terra_ltv_bot.limiter import BACKGROUND, INTERACTIVE, PriorityLimiter
+
+
+def test_background_leaves_the_reserve_to_interactive():
+    async def run() -> None:
+        limiter = PriorityLimiter(rate=1, burst=5, reserve=2)
+        for _ in range(3):
+            await limiter.acquire(BACKGROUND)
+        background = asyncio.ensure_future(limiter.acquire(BACKGROUND))
+        await asyncio.sleep(0)
+        assert not background.done()
+        await asyncio.wait_for(limiter.acquire(INTERACTIVE), 0.1)
+        await asyncio.wait_for(limiter.acquire(INTERACTIVE), 0.1)
+        background.cancel()
+
+    asyncio.run(run())
+
+
+def test_interactive_jumps_the_queue():
+    async def run() -> None:
+        limiter = PriorityLimiter(rate=100, burst=1, reserve=0)
+        await limiter.acquire(BACKGROUND)
+        order = []
+
+        async def acquire(tier: str) -> None:
+            await limiter.acquire(tier)
+            order.append(tier)
+
+        tasks = [asyncio.ensure_future(acquire(BACKGROUND)) for _ in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(acquire(INTERACTIVE)))
+        await asyncio.sleep(0)
+        assert limiter.depth(BACKGROUND) == 3
+        await asyncio.gather(*tasks)
+        assert order[0] == INTERACTIVE
+
+    asyncio.run(run())
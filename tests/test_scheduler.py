@@ -0,0 +1,90 @@
+from terra_ltv_bot.scheduler import Scheduler
+
+
+def test_new_addresses_are_due_right_away():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10)
+    scheduler.track("a", 45, now=0)
+    scheduler.track("b", 45, now=0)
+    assert sorted(scheduler.due(now=0)) == ["a", "b"]
+    assert scheduler.due(now=0) == []
+
+
+def test_risky_addresses_are_checked_sooner():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10)
+    scheduler.track("risky", 45, now=0)
+    scheduler.track("safe", 45, now=0)
+    scheduler.due(now=0)
+    scheduler.schedule("risky", 43, now=0)
+    scheduler.schedule("safe", 5, now=0)
+    assert scheduler.due(now=6) == ["risky"]
+    assert scheduler.next_check["safe"] == 300
+
+
+def test_budget_limits_addresses_per_tick():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=1)
+    for account_address in "abcdefgh":
+        scheduler.track(account_address, 45, now=0)
+    assert len(scheduler.due(now=0)) == 6
+    assert len(scheduler.due(now=0)) == 2
+
+
+def test_untracked_addresses_are_dropped():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10)
+    scheduler.track("a", 45, now=0)
+    scheduler.untrack("a")
+    assert scheduler.due(now=0) == []
+    assert len(scheduler) == 0
+
+
+def test_restore_keeps_next_checks_and_ltvs():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10)
+    scheduler.track("risky", 45, now=0)
+    scheduler.track("safe", 45, now=0)
+    scheduler.due(now=0)
+    scheduler.schedule("risky", 43, now=0)
+    scheduler.schedule("safe", 5, now=0)
+    restored = Scheduler(block_time=6, max_interval=300, budget=10)
+    restored.restore(scheduler.dump(now=0), now=1000)
+    restored.track("safe", 45, now=1000)
+    assert restored.ltvs == {"risky": 43, "safe": 5}
+    assert restored.due(now=1006) == ["risky"]
+    assert restored.due(now=1299) == ["risky"]
+    assert restored.due(now=1300) == ["safe"]
+
+
+def test_bumped_addresses_are_checked_first():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=1 / 6)
+    for account_address in "abc":
+        scheduler.track(account_address, 45, now=0)
+    scheduler.due(now=0)
+    scheduler.schedule("a", 5, now=0)
+    assert scheduler.bump(["c", "untracked"], now=1) == 1
+    assert scheduler.due(now=1) == ["c"]
+    assert scheduler.due(now=1) == ["b"]
+
+
+def test_saturated_budget_goes_to_near_addresses_first():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10 / 6)
+    for account_address in "abcdefghijklmnopqrst":
+        scheduler.track(account_address, 45, now=0)
+    scheduler.due(now=0)
+    scheduler.due(now=0)
+    for account_address in "abcdefghij":
+        scheduler.schedule(account_address, 5, now=0)
+    for account_address in "klmnopqrst":
+        scheduler.schedule(account_address, 43, now=290)
+    # the safe addresses are overdue, yet near ones keep all but the far share
+    due = scheduler.due(now=400)
+    assert sorted(due) == list("abklmnopqr")
+
+
+def test_failed_checks_are_retried_next_block():
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10)
+    scheduler.track("a", 45, now=0)
+    scheduler.due(now=0)
+    scheduler.schedule("a", 44, now=0)
+    scheduler.due(now=6)
+    scheduler.retry(["a", "untracked"], now=6)
+    assert scheduler.due(now=12) == ["a"]
+    assert scheduler.ltvs["a"] == 44
+    assert "untracked" not in scheduler.next_check
@@ -0,0 +1,32 @@
+from beanie.odm.fields import PydanticObjectId
+
+from terra_ltv_bot.index import SubscriptionIndex
+from terra_ltv_bot.models import Subscription
+from terra_ltv_bot.scheduler import Scheduler
+from terra_ltv_bot.snapshot import Snapshot
+
+SUBSCRIBED = "terra1" + "q" * 38
+UNSUBSCRIBED = "terra1" + "p" * 38
+
+
+def test_prune_untracks_addresses_missing_from_the_index():
+    index = SubscriptionIndex()
+    index.add(
+        SUBSCRIBED,
+        Subscription.construct(
+            id=PydanticObjectId(),
+            address_id=PydanticObjectId(),
+            protocol="anchor",
+            alert_threshold=None,
+            telegram_id=1,
+            telegram_name="1",
+        ),
+    )
+    index.drain_changes()
+    scheduler = Scheduler(block_time=6, max_interval=300, budget=10)
+    scheduler.restore({SUBSCRIBED: (45, 0, 10), UNSUBSCRIBED: (45, 0, 44)}, now=0)
+    snapshot = Snapshot(None, index, scheduler)  # type: ignore
+    assert snapshot.prune() == 1
+    assert list(scheduler.thresholds) == [SUBSCRIBED]
+    assert scheduler.due(now=0) == [SUBSCRIBED]
+    assert index.drain_changes() == {UNSUBSCRIBED}
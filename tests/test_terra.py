@@ -0,0 +1,244 @@
+import asyncio
+from decimal import Decimal
+
+from bech32 import bech32_encode, convertbits
+from terra_sdk.exceptions import LCDResponseError
+
+from terra_ltv_bot.lcd import LCDPool, LCDUnavailable
+from terra_ltv_bot.terra import (
+    PAGE_LIMIT,
+    Terra,
+    canonical_address,
+    ltv_ratio,
+    preceding_address,
+)
+
+MARKET = "market"
+OVERSEER = "overseer"
+ORACLE = "oracle"
+TOKEN = "bluna"
+
+
+class Response:
+    def __init__(self, status: int) -> None:
+        self.status = status
+
+
+def address(n: int) -> str:
+    return bech32_encode("terra", convertbits(n.to_bytes(20, "big"), 8, 5))
+
+
+class FakeAnchor:
+    """Answers anchor queries from borrower (loan, interest index, collateral)."""
+
+    def __init__(self, borrowers: dict[int, tuple[int, str, int]]) -> None:
+        self.borrowers = {address(n): b for n, b in sorted(borrowers.items())}
+        self.global_interest_index = Decimal("1.1")
+        self.price = Decimal(2)
+        self.max_ltv = Decimal("0.6")
+        self.unlisted_collaterals: set[str] = set()
+        self.failing: set[str] = set()
+        # start_after of the pages failing, with the error they fail with
+        self.failing_pages: dict[str, LCDResponseError] = {}
+        self.queries: list[tuple[str, dict]] = []
+
+    def loan(self, account_address: str) -> int:
+        loan, interest_index, _ = self.borrowers[account_address]
+        return int(loan * self.global_interest_index / Decimal(interest_index))
+
+    def page(self, args: dict, unlisted: set[str]) -> list[str]:
+        addresses = [a for a in self.borrowers if a not in unlisted]
+        if "start_after" in args:
+            after = canonical_address(args["start_after"])
+            addresses = [a for a in addresses if canonical_address(a) > after]
+        return addresses[: args["limit"]]
+
+    async def contract_query(self, contract_address: str, query: dict) -> dict:
+        name, args = next(iter(query.items()))
+        self.queries.append((name, args))
+        if name in self.failing:
+            raise LCDResponseError(message=name, response=Response(500))
+        if args.get("start_after") in self.failing_pages:
+            raise self.failing_pages[args["start_after"]]
+        if name == "borrower_infos":
+            return dict(
+                borrower_infos=[
+                    dict(borrower=a, loan_amount=str(loan), interest_index=index)
+                    for a in self.page(args, set())
+                    for loan, index, _ in [self.borrowers[a]]
+                ]
+            )
+        if name == "all_collaterals":
+            return dict(
+                all_collaterals=[
+                    dict(borrower=a, collaterals=[[TOKEN, str(self.borrowers[a][2])]])
+                    for a in self.page(args, self.unlisted_collaterals)
+                ]
+            )
+        if name == "state":
+            return dict(global_interest_index=str(self.global_interest_index))
+        if name == "whitelist":
+            return dict(elems=[dict(collateral_token=TOKEN, max_ltv=str(self.max_ltv))])
+        if name == "config":
+            return dict(oracle_contract=ORACLE)
+        if name == "prices":
+            return dict(prices=[dict(asset=TOKEN, price=str(self.price))])
+        if name == "borrower_info":
+            return dict(loan_amount=str(self.loan(args["borrower"])))
+        if name == "borrow_limit":
+            collateral = self.borrowers[args["borrower"]][2]
+            limit = int(collateral * self.price * self.max_ltv)
+            return dict(borrow_limit=str(limit))
+        raise ValueError(name)
+
+
+def terra_with(anchor: FakeAnchor) -> Terra:
+    terra = Terra(LCDPool(["http://lcd"], "test"), MARKET, OVERSEER)
+    terra.contract_query = anchor.contract_query  # type: ignore
+    return terra
+
+
+def test_preceding_address():
+    assert preceding_address(address(1)) == address(0)
+    assert preceding_address(address(256)) == address(255)
+    assert preceding_address(address(0)) is None
+
+
+def test_paginate_skips_pages_without_addresses():
+    anchor = FakeAnchor({n: (100, "1", 1000) for n in range(1, 101)})
+    terra = terra_with(anchor)
+    wanted = [address(1), address(2), address(50), address(99)]
+    found, failed = asyncio.run(terra.paginate(MARKET, "borrower_infos", wanted))
+    assert failed == []
+    assert set(wanted) <= set(found)
+    # the page from 1 holds 2, the ones from 31 to 49 and 81 to 98 are skipped
+    assert [args.get("start_after") for _, args in anchor.queries] == [
+        address(0),
+        address(49),
+        address(98),
+    ]
+    assert len(found) == 2 * PAGE_LIMIT + 2
+
+
+def test_paginate_stops_after_the_last_borrower():
+    anchor = FakeAnchor({n: (100, "1", 1000) for n in range(1, 11)})
+    terra = terra_with(anchor)
+    found, _ = asyncio.run(
+        terra.paginate(MARKET, "borrower_infos", [address(5), address(500)])
+    )
+    assert address(500) not in found
+    assert len(anchor.queries) == 1
+
+
+def test_ltv_many_matches_per_address_ltvs():
+    anchor = FakeAnchor(
+        {1: (600, "1", 1000), 2: (300, "1.05", 1000), 3: (0, "1", 1000)}
+    )
+    terra = terra_with(anchor)
+    addresses = [address(n) for n in (1, 2, 3, 4)]
+    ltvs = asyncio.run(terra.ltv_many(addresses))
+    # interest accrued since the borrowers last interaction counts
+    assert ltvs[address(1)] == ltv_ratio(660, 1200)
+    assert ltvs[address(3)] == ltvs[address(4)] == 0
+    for account_address in addresses[:2]:
+        assert ltvs[account_address] == asyncio.run(terra.ltv(account_address))
+
+
+def test_addresses_missed_by_pages_are_queried_one_by_one():
+    anchor = FakeAnchor({1: (600, "1", 1000), 2: (300, "1", 1000)})
+    anchor.unlisted_collaterals.add(address(2))
+    terra = terra_with(anchor)
+    ltvs = asyncio.run(terra.ltv_many([address(1), address(2)]))
+    assert ltvs[address(2)] == ltv_ratio(330, 1200)
+    assert [args for name, args in anchor.queries if name == "borrow_limit"] == [
+        dict(borrower=address(2))
+    ]
+
+
+def test_addresses_that_could_not_be_queried_are_left_out():
+    anchor = FakeAnchor({1: (600, "1", 1000), 2: (300, "1", 1000)})
+    anchor.unlisted_collaterals.add(address(2))
+    anchor.failing.add("borrow_limit")
+    terra = terra_with(anchor)
+    ltvs = asyncio.run(terra.ltv_many([address(1), address(2)]))
+    assert ltvs == {address(1): ltv_ratio(660, 1200)}
+    assert asyncio.run(terra.ltv(address(2))) is None
+
+
+def test_a_failed_page_only_falls_back_for_its_addresses():
+    anchor = FakeAnchor({n: (600, "1", 1000) for n in range(1, 101)})
+    anchor.failing_pages[address(49)] = LCDResponseError(
+        message="", response=Response(500)
+    )
+    terra = terra_with(anchor)
+    wanted = [address(1), address(2), address(50), address(99)]
+    ltvs = asyncio.run(terra.ltv_many(wanted))
+    assert ltvs == {a: ltv_ratio(660, 1200) for a in wanted}
+    # the pages around the failed one are kept
+    assert [args for name, args in anchor.queries if name == "borrower_info"] == [
+        dict(borrower=address(50))
+    ]
+
+
+def test_nothing_falls_back_when_the_lcd_is_unavailable():
+    anchor = FakeAnchor({n: (600, "1", 1000) for n in range(1, 11)})
+    anchor.failing_pages[address(0)] = LCDUnavailable(ValueError())
+    terra = terra_with(anchor)
+    assert asyncio.run(terra.ltv_many([address(1), address(2)])) == {}
+    assert not [name for name, _ in anchor.queries if name == "borrower_info"]
+
+
+def test_ltv_many_reuses_a_shared_market():
+    anchor = FakeAnchor({1: (600, "1", 1000)})
+    terra = terra_with(anchor)
+    market = asyncio.run(terra.market())
+    anchor.queries.clear()
+    ltvs = asyncio.run(terra.ltv_many([address(1)], market))
+    assert ltvs[address(1)] == ltv_ratio(660, 1200)
+    assert [name for name, _ in anchor.queries] == [
+        "borrower_infos",
+        "all_collaterals",
+    ]
+
+
+def test_commands_do_not_join_background_ltv_calls():
+    async def run() -> None:
+        terra = terra_with(FakeAnchor({1: (600, "1", 1000)}))
+        background = asyncio.ensure_future(terra.ltv(address(1)))
+        await asyncio.sleep(0)
+        with terra.interactive():
+            await asyncio.gather(terra.ltv(address(1)), terra.ltv(address(1)))
+        await background
+        # the second command joined the first one only
+        assert terra.ltv_flight.coalesced == 1
+
+    asyncio.run(run())
+
+
+def test_delegators_are_paged():
+    pages = {
+        None: dict(
+            delegation_responses=[
+                dict(delegation=dict(delegator_address="a"), balance=dict(amount="1")),
+                dict(delegation=dict(delegator_address="b"), balance=dict(amount="0")),
+            ],
+            pagination=dict(next_key="next"),
+        ),
+        "next": dict(
+            delegation_responses=[
+                dict(delegation=dict(delegator_address="c"), balance=dict(amount="2"))
+            ],
+            pagination=dict(next_key=None),
+        ),
+    }
+
+    class LCD:
+        async def _get(self, path: str, params: dict, raw: bool) -> dict:
+            return pages[params.get("pagination.key")]
+
+    async def request(f, tier):
+        return await f(LCD())
+
+    terra = terra_with(FakeAnchor({}))
+    terra.pool.request = request  # type: ignore
+    assert asyncio.run(terra.delegators("terravaloper1")) == {"a", "c"}
@@ -0,0 +1,36 @@
+from terra_ltv_bot.triggers import TriggerIndex
+
+
+def test_price_fall_touches_crossed_triggers_only():
+    triggers = TriggerIndex()
+    # ltv = loan * 60 / (amount * max_ltv * price), 45% at price 2 and 1
+    triggers.update("near", loan=15, weights={"bluna": 10}, thresholds={1: 45})
+    triggers.update("far", loan=7.5, weights={"bluna": 10}, thresholds={1: 45})
+    assert triggers.tick({"bluna": 3}) == set()
+    assert triggers.tick({"bluna": 2.5}) == set()
+    assert triggers.tick({"bluna": 1.5}) == {"near"}
+    assert triggers.tick({"bluna": 3}) == set()
+    assert triggers.tick({"bluna": 0.5}) == {"near", "far"}
+
+
+def test_each_subscription_has_its_trigger():
+    triggers = TriggerIndex()
+    triggers.tick({"bluna": 3.5})
+    triggers.update("a", loan=15, weights={"bluna": 10}, thresholds={1: 45, 2: 30})
+    assert len(triggers) == 2
+    # the 30% subscription triggers at price 3
+    assert triggers.tick({"bluna": 2.9}) == {"a"}
+    assert triggers.tick({"bluna": 2.1}) == set()
+    assert triggers.tick({"bluna": 1.9}) == {"a"}
+
+
+def test_updates_and_removals_replace_triggers():
+    triggers = TriggerIndex()
+    triggers.tick({"bluna": 3})
+    triggers.update("a", loan=15, weights={"bluna": 10}, thresholds={1: 45})
+    triggers.update("a", loan=0, weights={"bluna": 10}, thresholds={1: 45})
+    assert len(triggers) == 0
+    triggers.update("b", loan=15, weights={"bluna": 10, "beth": 1}, thresholds={})
+    assert triggers.tick({"bluna": 3}) == {"b"}
+    triggers.remove("b")
+    assert triggers.tick({"bluna": 0.1}) == set()